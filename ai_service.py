@@ -1,8 +1,23 @@
-import json
+import asyncio
 import logging
-from typing import Dict, List, Optional
+import re
+import time
+from collections import OrderedDict, deque
+from contextlib import suppress
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
 
+import httpx
+import numpy as np
+import openai
+import orjson
 from openai import AsyncOpenAI
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -11,23 +26,190 @@ logger = logging.getLogger(__name__)
 #   Инициализация OpenAI API
 # ==============================================
 
-client: Optional[AsyncOpenAI] = None
+# Клиент создаётся лениво при первом запросе: один пул соединений (HTTP/2)
+# на чат, эмбеддинги и Batch API.
+_CLIENT: Optional[AsyncOpenAI] = None
+_api_key: Optional[str] = None
 
-def init_openai(api_key: str) -> None:
+def init_openai(
+    api_key: str,
+    semantic_threshold: float = 0.92,
+    max_concurrency: Optional[int] = None,
+    rpm_limit: Optional[int] = None,
+) -> None:
     """
-    Инициализирует OpenAI API ключ.
-    Вызывается один раз при запуске бота.
+    Запоминает настройки OpenAI API. Вызывается один раз при запуске бота.
+    Сам клиент создаётся при первом обращении (см. _get_client).
+
+    Args:
+        api_key: ключ OpenAI (если не задан — SDK возьмёт OPENAI_API_KEY из окружения)
+        semantic_threshold: порог косинусной близости для семантического кэша
+            (>= 1.0 — кэш выключен)
+        max_concurrency: сколько запросов к чату одновременно (по умолчанию OPENAI_MAX_CONCURRENCY)
+        rpm_limit: сколько запросов к чату в минуту (по умолчанию OPENAI_RPM_LIMIT, 0 — без лимита)
     """
-    global client
-    client = AsyncOpenAI(api_key=api_key)
+    global _api_key, _semantic_threshold, _OPENAI_SEM, _rpm_limit
+    _api_key = api_key
+    _semantic_threshold = semantic_threshold
+    if max_concurrency is not None:
+        _OPENAI_SEM = asyncio.Semaphore(max_concurrency)
+    if rpm_limit is not None:
+        _rpm_limit = rpm_limit
     logger.info("✅ OpenAI API инициализирован")
 
 
+def _get_client() -> AsyncOpenAI:
+    """
+    Возвращает общий AsyncOpenAI, при первом вызове создаёт его поверх
+    httpx.AsyncClient с HTTP/2 и постоянным пулом keep-alive соединений.
+    """
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = AsyncOpenAI(
+            api_key=_api_key,
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+                timeout=httpx.Timeout(30.0, connect=5.0),
+            ),
+        )
+    return _CLIENT
+
+
+async def close_openai() -> None:
+    """
+    Закрывает пул соединений OpenAI (при остановке бота).
+    """
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.close()
+        _CLIENT = None
+
+
+# ==============================================
+#   Семантический кэш результатов анализа
+# ==============================================
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_SIZE = 256  # максимум записей на одного пользователя
+SEMANTIC_CACHE_INITIAL_ROWS = 16  # матрица растёт удвоением до SEMANTIC_CACHE_SIZE
+SEMANTIC_CACHE_USERS = 500  # сколько пользователей держим в кэше (LRU)
+
+_semantic_threshold: float = 0.92
+
+
+class _UserSemanticCache:
+    """
+    Кэш одного пользователя: кольцевой буфер на SEMANTIC_CACHE_SIZE записей.
+    Эмбеддинги лежат одной матрицей (N, dim) float32 и уже нормированы, поэтому
+    косинусная близость — это одно умножение матрицы на вектор. Матрица растёт
+    удвоением: пользователь с парой заметок не занимает полные 1.5 МБ.
+    """
+
+    __slots__ = ("vectors", "results", "size", "next")
+
+    def __init__(self, dim: int) -> None:
+        self.vectors = np.empty((SEMANTIC_CACHE_INITIAL_ROWS, dim), dtype=np.float32)
+        self.results: List[Dict[str, str]] = []
+        self.size = 0   # сколько строк заполнено
+        self.next = 0   # куда писать следующую (самая старая при переполнении)
+
+    def lookup(self, vec: np.ndarray, threshold: float) -> Optional[Dict[str, str]]:
+        if self.size == 0:
+            return None
+
+        sims = self.vectors[:self.size] @ vec
+        best = int(np.argmax(sims))
+
+        if sims[best] < threshold:
+            return None
+        return dict(self.results[best])
+
+    def add(self, vec: np.ndarray, result: Dict[str, str]) -> None:
+        if self.size < SEMANTIC_CACHE_SIZE:
+            if self.size == self.vectors.shape[0]:
+                rows = min(self.size * 2, SEMANTIC_CACHE_SIZE)
+                grown = np.empty((rows, self.vectors.shape[1]), dtype=np.float32)
+                grown[:self.size] = self.vectors
+                self.vectors = grown
+            # пока буфер не заполнен, next == size
+            self.vectors[self.size] = vec
+            self.results.append(dict(result))
+            self.size += 1
+        else:
+            self.vectors[self.next] = vec
+            self.results[self.next] = dict(result)
+        self.next = (self.next + 1) % SEMANTIC_CACHE_SIZE
+
+
+# user_id → кэш пользователя; давно не писавшие вытесняются (LRU)
+_SEMANTIC_CACHE: "OrderedDict[int, _UserSemanticCache]" = OrderedDict()
+
+
+def _semantic_cache_for(user_id: int, dim: int) -> _UserSemanticCache:
+    cache = _SEMANTIC_CACHE.get(user_id)
+    if cache is None:
+        cache = _SEMANTIC_CACHE[user_id] = _UserSemanticCache(dim)
+        if len(_SEMANTIC_CACHE) > SEMANTIC_CACHE_USERS:
+            _SEMANTIC_CACHE.popitem(last=False)
+    _SEMANTIC_CACHE.move_to_end(user_id)
+    return cache
+
+
+async def _embed(text: str) -> Optional[np.ndarray]:
+    """
+    Считает эмбеддинг заметки (нормированный к единичной длине).
+    При ошибке возвращает None — анализ пойдёт без кэша.
+    """
+    try:
+        embedding = await _create_embedding(text)
+    except Exception as e:
+        logger.warning("⚠️ Не удалось получить эмбеддинг: %s", e)
+        return None
+    vec = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else None
+
+
+# ==============================================
+#   Точный LRU-кэш (тот же текст + те же категории)
+# ==============================================
+
+EXACT_CACHE_SIZE = 5000
+EXACT_CACHE_TTL = 24 * 60 * 60  # сек: описания брендов/терминов со временем устаревают
+
+# ключ → (время записи, результат)
+_EXACT_CACHE: "OrderedDict[Tuple[str, Tuple[str, ...]], Tuple[float, Dict[str, str]]]" = OrderedDict()
+
+
+def _exact_key(text: str, user_categories: Optional[Sequence[str]]) -> Tuple[str, Tuple[str, ...]]:
+    return text.strip().casefold(), tuple(sorted(user_categories or ()))
+
+
+def _exact_get(key: Tuple[str, Tuple[str, ...]]) -> Optional[Dict[str, str]]:
+    entry = _EXACT_CACHE.get(key)
+    if entry is None:
+        return None
+    if time.monotonic() - entry[0] > EXACT_CACHE_TTL:
+        del _EXACT_CACHE[key]
+        return None
+    _EXACT_CACHE.move_to_end(key)
+    return dict(entry[1])
+
+
+def _exact_put(key: Tuple[str, Tuple[str, ...]], result: Dict[str, str]) -> None:
+    _EXACT_CACHE[key] = (time.monotonic(), dict(result))
+    _EXACT_CACHE.move_to_end(key)
+    if len(_EXACT_CACHE) > EXACT_CACHE_SIZE:
+        _EXACT_CACHE.popitem(last=False)
+
+
 # ==============================================
 #   Список категорий по умолчанию
 # ==============================================
 
-DEFAULT_CATEGORIES = {
+# Отсортирован заранее: без пользовательских категорий возвращается как есть
+DEFAULT_CATEGORIES: Tuple[str, ...] = tuple(sorted({
     "🛒 Покупки",
     "💡 Идеи",
     "🍳 Рецепты",
@@ -35,70 +217,51 @@ DEFAULT_CATEGORIES = {
     "📚 Книги",
     "🎵 Музыка",
     "🎯 Прочее",
-}
+}))
 
 
 # ==============================================
 #   Получение доступных категорий
 # ==============================================
 
-async def get_available_categories(user_categories: Optional[List[str]] = None) -> List[str]:
+def get_available_categories(user_categories: Optional[Sequence[str]] = None) -> Tuple[str, ...]:
     """
     Объединяет категории по умолчанию с существующими категориями пользователя.
     ИИ будет выбирать из этого списка или создавать новую.
     
     Args:
-        user_categories: список уже использованных категорий пользователем (или None)
+        user_categories: уже использованные категории пользователя без None (или None)
     
     Returns:
-        отсортированный список всех доступных категорий
+        отсортированный кортеж всех доступных категорий
     """
-    all_categories = DEFAULT_CATEGORIES.copy()
-    
-    if user_categories:
-        valid_categories = [cat for cat in user_categories if cat is not None]
-        all_categories.update(set(valid_categories))
+    if not user_categories:
+        return DEFAULT_CATEGORIES
     
-    return sorted(list(all_categories))
+    return tuple(sorted(set(DEFAULT_CATEGORIES).union(user_categories)))
 
 
 # ==============================================
-#   Основная функция анализа заметки
+#   Промпт (статичная часть собрана один раз)
 # ==============================================
 
-async def analyze_note(
-    text: str, 
-    user_categories: Optional[List[str]] = None
-) -> Dict[str, str]:
-    """
-    Анализирует заметку через OpenAI API.
-    Определяет категорию и генерирует развёрнутое описание.
-    
-    ВАЖНО: 
-    - Сохраняет исходный текст как есть
-    - Определяет категорию (может быть существующей или новой)
-    - Генерирует описание с контекстом, пояснениями и рекомендациями
-    
-    Args:
-        text: текст заметки от пользователя (может быть с ошибками, в спешке и т.д.)
-        user_categories: существующие категории пользователя (для контекста)
-    
-    Returns:
-        dict:
-        {
-            "category": "🛒 Покупки",  # существующая или новая
-            "description": "Молочные продукты и хлеб. Можно приготовить..."
-        }
-    """
-    
-    available_categories = await get_available_categories(user_categories)
-    categories_str = "\n".join(available_categories)
-    
-    # ════════════════════════════════════════════════════════════
-    # Формируем промпт для OpenAI
-    # ════════════════════════════════════════════════════════════
-    
-    prompt = f"""You are a personal note assistant.
+# Системное сообщение и шапка промпта не меняются между вызовами —
+# одинаковый префикс позволяет OpenAI переиспользовать закэшированные токены.
+
+_SYSTEM_MSG = (
+    "You are a personal AI assistant for analyzing and interpreting short notes.\n"
+    "\n"
+    "Follow these permanent rules:\n"
+    "1. Always respond **in Russian language**.\n"
+    "2. Respond with a JSON object of this structure:\n"
+    "{\n"
+    '  "category": "existing or new category with emoji",\n'
+    '  "description": "1–2 short sentences in Russian (≤220 characters). Avoid repetition and advice; focus on clarity and context."\n'
+    "}\n"
+    "3. Be extremely precise when identifying categories and expanding abbreviations."
+)
+
+_PROMPT_HEADER = """You are a personal note assistant.
 
 Users write short, messy notes — often with typos, slang, or abbreviations.
 Your job is to **understand what they meant**, expand abbreviations, and add a bit of practical context.
@@ -128,14 +291,10 @@ Examples:
 - "Claude" → Claude — языковая модель от Anthropic.
 - "SaaS" → Software as a Service — модель, при которой софт предоставляется по подписке через интернет.
 
-
 ═══════════════════════════════════════════════════════════════
-🗂️ CATEGORIES:
+🗂️ CATEGORY RULES:
 ═══════════════════════════════════════════════════════════════
-{categories_str}
-
-Rules:
-1. If the note clearly fits one of the existing categories, choose it.
+1. If the note clearly fits one of the existing categories (listed below), choose it.
 2. If it doesn’t fit any, **create a new one** (for example: "🎮 Игры", "🤖 ИИ Инструменты", "📺 Аниме", "✈️ Путешествия", "🧠 Саморазвитие").
 3. Never say “create new category” — just create it.
 4. Use "🎯 Прочее" only if the category is truly unclear.
@@ -155,82 +314,322 @@ Your description must:
     • 🎵 Музыка — artist and style, no biography.
     • 🤖 ИИ Инструменты — explain what the tool does and its purpose.
     • For others — one concise clarification of meaning or context.
+"""
 
+_PROMPT_CATEGORIES_FMT = """
 ═══════════════════════════════════════════════════════════════
-📝 USER NOTE:
+🗂️ EXISTING CATEGORIES:
 ═══════════════════════════════════════════════════════════════
-"{text}"
+{categories}
+"""
 
+_PROMPT_NOTE_FMT = """
 ═══════════════════════════════════════════════════════════════
-📦 OUTPUT FORMAT:
+📝 USER NOTE:
 ═══════════════════════════════════════════════════════════════
-Return **only valid JSON**, nothing else:
+"{text}"
+"""
+
+
+# ==============================================
+#   Сборка запроса и разбор ответа
+# ==============================================
+
+MODEL_DEFAULT = "gpt-4o-mini"
+MODEL_LIGHT = "gpt-4.1-nano"   # короткие простые заметки: дешевле и быстрее
+LIGHT_MODEL_MAX_LEN = 40
+
+# Латиница/цифры подряд — скорее всего бренд, модель или аббревиатура,
+# такие заметки требуют более сильной модели
+_ABBREV_RE = re.compile(r"[A-Za-z0-9]{3,}")
+
+
+def _pick_model(text: str) -> str:
+    """
+    Выбирает модель для заметки: лёгкую для коротких бытовых заметок,
+    MODEL_DEFAULT — для длинных и тех, где есть аббревиатуры/названия.
+    """
+    if len(text) > LIGHT_MODEL_MAX_LEN or _ABBREV_RE.search(text):
+        return MODEL_DEFAULT
+    return MODEL_LIGHT
+
+
+@lru_cache(maxsize=1024)
+def _categories_block(available_categories: Tuple[str, ...]) -> str:
+    # Блок запоминается по самому списку категорий, а не по пользователю:
+    # у большинства пользователей списки совпадают или меняются редко
+    return _PROMPT_CATEGORIES_FMT.format(categories="\n".join(available_categories))
+
+
+def format_categories(user_categories: Optional[Sequence[str]] = None) -> str:
+    """
+    Готовый блок категорий для промпта (категории по умолчанию + пользовательские).
+    Вызывающий код может передавать его в analyze_note как categories_str.
+    """
+    return _categories_block(get_available_categories(user_categories))
+
+
+def _build_request(text: str, categories_str: str) -> Dict:
+    """
+    Собирает тело запроса к chat.completions для одной заметки.
+    Используется и для прямого вызова, и для Batch API.
+    """
+    prompt = (
+        _PROMPT_HEADER
+        + categories_str
+        + _PROMPT_NOTE_FMT.format(text=text)
+    )
+
+    return dict(
+        model=_pick_model(text),
+        messages=[
+            {"role": "system", "content": _SYSTEM_MSG},
+            {"role": "user", "content": prompt},
+        ],
+        response_format={"type": "json_object"},
+        temperature=0.2,
+        # ≤220 символов описания ≈ 80–100 токенов + ~15 на категорию и JSON
+        max_tokens=120,
+        top_p=0.8
+    )
+
+
+def _parse_result(response_text: str) -> Dict[str, str]:
+    """
+    Разбирает JSON-ответ модели в {"category", "description"}.
+    Бросает orjson.JSONDecodeError, если ответ не JSON.
+    """
+    result = orjson.loads(response_text)
+    
+    category = result.get("category", "🎯 Прочее").strip()
+    description = result.get("description", "").strip()
+    
+    return {
+        "category": category,
+        "description": description
+    }
+
+
+# ==============================================
+#   Вызов OpenAI: ограничение параллелизма + ретраи
+# ==============================================
+
+OPENAI_MAX_CONCURRENCY = 8
+OPENAI_RPM_LIMIT = 500          # лимит запросов в минуту для аккаунта (tier 1 для gpt-4o-mini)
+
+CategoryCallback = Callable[[str], Awaitable[None]]
+
+# Категория в ещё недописанном JSON-ответе
+_CATEGORY_FIELD_RE = re.compile(r'"category"\s*:\s*"([^"]+)"')
+
+_OPENAI_SEM = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+_backoff = wait_exponential_jitter(initial=1, max=30)
+
+# Скользящее окно запросов за последнюю минуту: не выходим за RPM,
+# вместо того чтобы получать 429 и ждать ретраев
+_rpm_limit = OPENAI_RPM_LIMIT
+_request_times: deque = deque()
+_rate_lock = asyncio.Lock()
+
+
+async def _wait_for_rate_slot() -> None:
+    """
+    Ждёт, пока за последние 60 секунд было меньше _rpm_limit запросов,
+    и записывает текущий запрос в окно.
+    """
+    if _rpm_limit <= 0:
+        return
+    async with _rate_lock:
+        while True:
+            now = time.monotonic()
+            while _request_times and now - _request_times[0] >= 60.0:
+                _request_times.popleft()
+            if len(_request_times) < _rpm_limit:
+                _request_times.append(now)
+                return
+            await asyncio.sleep(60.0 - (now - _request_times[0]))
+
+
+def _wait_retry_after(retry_state) -> float:
+    """
+    Сколько ждать перед повтором: если OpenAI прислал Retry-After (429) — столько,
+    иначе экспоненциальная задержка с джиттером.
+    """
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, openai.RateLimitError):
+        retry_after = exc.response.headers.get("retry-after")
+        with suppress(TypeError, ValueError):
+            return min(float(retry_after), 30.0)
+    return _backoff(retry_state)
+
+
+# Политика повторов для запросов к чату
+_openai_retry = retry(
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type(
+        (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)
+    ),
+    reraise=True,
+)
+
+# Эмбеддинг нужен только для кэша: лучше пропустить кэш, чем задержать заметку.
+# Отдельный семафор и без RPM-окна чата — у эндпоинта эмбеддингов свои лимиты.
+EMBEDDING_TIMEOUT = 3.0  # сек
+_EMBED_SEM = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+
+async def _create_embedding(text: str) -> List[float]:
+    """
+    Запрос эмбеддинга: одна попытка с коротким таймаутом, без ретраев SDK.
+    """
+    async with _EMBED_SEM:
+        response = await _get_client().with_options(max_retries=0).embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=text,
+            timeout=EMBEDDING_TIMEOUT,
+        )
+    return response.data[0].embedding
+
+
+@_openai_retry
+async def _call_openai(params: Dict, on_category: Optional[CategoryCallback] = None) -> str:
+    """
+    Вызывает chat.completions не более чем в OPENAI_MAX_CONCURRENCY потоков
+    и не чаще _rpm_limit раз в минуту, возвращает текст ответа.
+    Семафор берётся на каждую попытку, поэтому ожидание ретрая не занимает слот.
+    
+    Ответ читается потоком: как только в JSON появилась категория,
+    она отдаётся в on_category — пользователь видит её до конца генерации.
+    """
+    async with _OPENAI_SEM:
+        await _wait_for_rate_slot()
+        stream = await _get_client().chat.completions.create(**params, stream=True)
+        
+        parts: List[str] = []
+        category_sent = on_category is None
+        
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            parts.append(delta)
+            
+            if not category_sent:
+                match = _CATEGORY_FIELD_RE.search("".join(parts))
+                if match:
+                    category_sent = True
+                    with suppress(Exception):
+                        await on_category(match.group(1))
+        
+        return "".join(parts).strip()
+
 
-{{
-    "category": "existing or new category with emoji",
-    "description": "1–2 short sentences in Russian (≤220 characters). Avoid repetition and advice; focus on clarity and context."
-}}"""
+# ==============================================
+#   Основная функция анализа заметки
+# ==============================================
 
+async def analyze_note(
+    text: str, 
+    user_categories: Optional[Sequence[str]] = None,
+    user_id: Optional[int] = None,
+    on_category: Optional[CategoryCallback] = None,
+    categories_str: Optional[str] = None
+) -> Dict[str, str]:
+    """
+    Анализирует заметку через OpenAI API.
+    Определяет категорию и генерирует развёрнутое описание.
+    
+    ВАЖНО: 
+    - Сохраняет исходный текст как есть
+    - Определяет категорию (может быть существующей или новой)
+    - Генерирует описание с контекстом, пояснениями и рекомендациями
+    
+    Если запущен run_coalesce_worker, запрос к OpenAI идёт через очередь склейки.
+    
+    Args:
+        text: текст заметки от пользователя (может быть с ошибками, в спешке и т.д.)
+        user_categories: существующие категории пользователя (для контекста)
+        user_id: ID пользователя — включает семантический кэш похожих заметок
+        on_category: корутина, которая получит категорию сразу, как только модель её выдаст
+        categories_str: готовый блок категорий (format_categories) — если вызывающий
+                        код его закэшировал; иначе собирается из user_categories
+    
+    Returns:
+        dict:
+        {
+            "category": "🛒 Покупки",  # существующая или новая
+            "description": "Молочные продукты и хлеб. Можно приготовить..."
+        }
+    """
+    
+    # Точный повтор — отвечаем из кэша, даже не собирая промпт
+    exact_key = _exact_key(text, user_categories)
+    cached = _exact_get(exact_key)
+    if cached is not None:
+        logger.info("⚡ Точный кэш: %s", cached['category'])
+        return cached
+    
     try:
-        logger.info(f"🤖 Анализирую заметку: '{text}'")
+        logger.info("🤖 Анализирую заметку: '%s'", text)
         
         # ════════════════════════════════════════════════════════════
-        # Вызываем OpenAI API (новый синтаксис)
+        # Семантический кэш: похожая заметка уже разбиралась → без LLM
         # ════════════════════════════════════════════════════════════
         
-        if client is None:
-            raise RuntimeError("OpenAI client не инициализирован. Вызови init_openai() первым.")
-        
-        response = await client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a personal AI assistant for analyzing and interpreting short notes.\n"
-                        "\n"
-                        "Follow these permanent rules:\n"
-                        "1. Always respond **in Russian language**.\n"
-                        "2. Return **only valid JSON** — no explanations, greetings, or comments.\n"
-                        "3. Output structure:\n"
-                        "{\n"
-                        '  "category": "existing or new category with emoji",\n'
-                        '  "description": "1–2 short sentences in Russian (≤220 characters). Avoid repetition and advice; focus on clarity and context."\n'
-                        "}\n"
-                        "4. Be extremely precise when identifying categories and expanding abbreviations.\n"
-                        "5. Never output anything except JSON — not even confirmations or formatting notes."
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            temperature=0.2,
-            max_tokens=220,
-            top_p=0.8
-        )
+        embedding = None
+        if user_id is not None and _semantic_threshold < 1.0:
+            embedding = await _embed(text)
+            if embedding is not None:
+                cached = _SEMANTIC_CACHE.get(user_id)
+                if cached is not None:
+                    _SEMANTIC_CACHE.move_to_end(user_id)
+                hit = cached.lookup(embedding, _semantic_threshold) if cached else None
+                if hit is not None:
+                    # В общий точный кэш не кладём: это приблизительный ответ
+                    # для чужого текста и только для этого пользователя
+                    logger.info("⚡ Семантический кэш: %s", hit['category'])
+                    return hit
         
         # ════════════════════════════════════════════════════════════
-        # Парсим ответ
+        # Вызываем OpenAI API (новый синтаксис)
         # ════════════════════════════════════════════════════════════
         
-        response_text = response.choices[0].message.content.strip()
-        result = json.loads(response_text)
+        if categories_str is None:
+            categories_str = format_categories(user_categories)
         
-        category = result.get("category", "🎯 Прочее").strip()
-        description = result.get("description", "").strip()
+        if _COALESCE_QUEUE is not None:
+            # Склейка включена: заметка уйдёт одним запросом вместе с соседними
+            # (on_category в этом режиме не вызывается — ответ не потоковый)
+            future = asyncio.get_running_loop().create_future()
+            _COALESCE_QUEUE.put_nowait((text, categories_str, future))
+            result = await future
+        else:
+            params = _build_request(text, categories_str)
+            logger.info("🧩 Модель %s для заметки: '%s'", params['model'], text)
+            
+            response_text = await _call_openai(params, on_category)
+            
+            # ════════════════════════════════════════════════════════════
+            # Парсим ответ
+            # ════════════════════════════════════════════════════════════
+            
+            result = _parse_result(response_text)
         
-        logger.info(f"✅ Анализ готов: {category}")
+        logger.info("✅ Анализ готов: %s", result['category'])
         
-        return {
-            "category": category,
-            "description": description
-        }
+        _exact_put(exact_key, result)
+        if embedding is not None:
+            _semantic_cache_for(user_id, embedding.shape[0]).add(embedding, result)
+        
+        return result
         
-    except json.JSONDecodeError as e:
-        logger.error(f"❌ ИИ вернул невалидный JSON: {e}")
-        logger.error(f"   Ответ был: {response_text if 'response_text' in locals() else 'N/A'}")
+    except (orjson.JSONDecodeError, ValueError) as e:
+        # В JSON-режиме такое бывает только при обрыве ответа (например, по max_tokens)
+        logger.warning("⚠️ ИИ вернул невалидный JSON: %s", e)
+        logger.warning("   Ответ был: %s", response_text if 'response_text' in locals() else 'N/A')
         
         # Fallback: вернём категорию по умолчанию
         return {
@@ -239,7 +638,7 @@ Return **only valid JSON**, nothing else:
         }
         
     except Exception as e:
-        logger.error(f"❌ Ошибка при вызове OpenAI API: {e}", exc_info=True)
+        logger.error("❌ Ошибка при вызове OpenAI API: %s", e, exc_info=True)
         
         # Fallback: если API недоступен
         return {
@@ -248,10 +647,367 @@ Return **only valid JSON**, nothing else:
         }
 
 
+# ==============================================
+#   Склейка одновременных заметок в один запрос
+# ==============================================
+
+COALESCE_WINDOW = 0.2         # сек: сколько ждать соседние заметки после первой
+COALESCE_MAX_ITEMS = 8        # не больше стольких заметок в одном запросе
+
+# Очередь (текст, блок категорий, future); None — склейка выключена
+_COALESCE_QUEUE: Optional[asyncio.Queue] = None
+_coalesce_tasks: set = set()
+
+# Для склеенного запроса нужен свой формат ответа: общий _SYSTEM_MSG
+# требует один объект {"category", "description"}
+_SYSTEM_MSG_BATCH = (
+    "You are a personal AI assistant for analyzing and interpreting short notes.\n"
+    "\n"
+    "Follow these permanent rules:\n"
+    "1. Always respond **in Russian language**.\n"
+    "2. You receive several notes at once. Respond with a JSON object of this structure:\n"
+    "{\n"
+    '  "results": [\n'
+    '    {"category": "existing or new category with emoji", '
+    '"description": "1–2 short sentences in Russian (≤220 characters)"}\n'
+    "  ]\n"
+    "}\n"
+    "   with exactly one item per note, in the same order as the notes.\n"
+    "3. Be extremely precise when identifying categories and expanding abbreviations."
+)
+
+_PROMPT_NOTES_FMT = """
+═══════════════════════════════════════════════════════════════
+📝 USER NOTES (JSON array, analyze each one separately):
+═══════════════════════════════════════════════════════════════
+{notes}
+
+Respond with {{"results": [...]}} — one object with "category" and "description"
+per note, in the same order as the notes.
+"""
+
+
+def _build_batch_request(texts: Sequence[str], categories_str: str) -> Dict:
+    """
+    Собирает один запрос к chat.completions для нескольких заметок
+    с общим блоком категорий.
+    """
+    prompt = (
+        _PROMPT_HEADER
+        + categories_str
+        + _PROMPT_NOTES_FMT.format(notes=orjson.dumps(list(texts)).decode())
+    )
+
+    return dict(
+        model=MODEL_DEFAULT,
+        messages=[
+            {"role": "system", "content": _SYSTEM_MSG_BATCH},
+            {"role": "user", "content": prompt},
+        ],
+        response_format={"type": "json_object"},
+        temperature=0.2,
+        max_tokens=120 * len(texts),
+        top_p=0.8
+    )
+
+
+async def analyze_note_batch(texts: Sequence[str], categories_str: str) -> List[Dict[str, str]]:
+    """
+    Анализирует несколько заметок одним запросом к OpenAI.
+    
+    Returns:
+        список {"category", "description"} в порядке texts
+    
+    Raises:
+        ValueError: если модель вернула не столько ответов, сколько заметок
+    """
+    response_text = await _call_openai(_build_batch_request(texts, categories_str))
+    results = orjson.loads(response_text).get("results")
+    if not isinstance(results, list) or len(results) != len(texts):
+        raise ValueError(f"ожидалось {len(texts)} ответов, получено: {response_text!r}")
+    
+    return [
+        {
+            "category": str(item.get("category", "🎯 Прочее")).strip(),
+            "description": str(item.get("description", "")).strip(),
+        }
+        for item in results
+    ]
+
+
+async def run_coalesce_worker() -> None:
+    """
+    Фоновая задача: собирает заметки, пришедшие в пределах COALESCE_WINDOW,
+    и отправляет их одним запросом (отдельно для каждого блока категорий).
+    Пока задача запущена, analyze_note ходит в OpenAI через неё.
+    """
+    global _COALESCE_QUEUE
+    _COALESCE_QUEUE = queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    
+    try:
+        while True:
+            items = [await queue.get()]
+            deadline = loop.time() + COALESCE_WINDOW
+            while len(items) < COALESCE_MAX_ITEMS:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Склеивать можно только заметки с одинаковым списком категорий
+            groups: Dict[str, List[Tuple]] = {}
+            for item in items:
+                groups.setdefault(item[1], []).append(item)
+            
+            for categories_str, group in groups.items():
+                task = asyncio.create_task(_analyze_group(categories_str, group))
+                _coalesce_tasks.add(task)
+                task.add_done_callback(_coalesce_tasks.discard)
+    finally:
+        _COALESCE_QUEUE = None
+        # Остановка: заметки, не успевшие уйти в запрос, получают ошибку
+        # (analyze_note вернёт запасной результат), а не висят без ответа
+        while not queue.empty():
+            _, _, future = queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("склейка запросов остановлена"))
+        tasks = list(_coalesce_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _analyze_group(categories_str: str, group: List[Tuple]) -> None:
+    """
+    Отправляет группу заметок в OpenAI и раздаёт результаты ожидающим future.
+    """
+    try:
+        await _resolve_group(categories_str, group)
+    finally:
+        # Задачу отменили при остановке — не оставляем ожидающих без ответа
+        for _, _, future in group:
+            if not future.done():
+                future.set_exception(RuntimeError("склейка запросов остановлена"))
+
+
+async def _resolve_group(categories_str: str, group: List[Tuple]) -> None:
+    """
+    Склеенный запрос, а если он не удался — по одной заметке.
+    """
+    texts = [text for text, _, _ in group]
+    if len(texts) > 1:
+        logger.info("🧩 Склеено %d заметок в один запрос", len(texts))
+        try:
+            results = await analyze_note_batch(texts, categories_str)
+        except Exception as e:
+            # Не тот формат или число ответов — разбираем заметки по одной
+            logger.warning("⚠️ Склеенный запрос не удался (%s), анализ по одной заметке", e)
+        else:
+            for (_, _, future), result in zip(group, results):
+                if not future.done():
+                    future.set_result(result)
+            return
+    
+    outcomes = await asyncio.gather(
+        *(_analyze_one(text, categories_str) for text in texts),
+        return_exceptions=True,
+    )
+    for (_, _, future), outcome in zip(group, outcomes):
+        if future.done():
+            continue
+        if isinstance(outcome, BaseException):
+            future.set_exception(outcome)
+        else:
+            future.set_result(outcome)
+
+
+async def _analyze_one(text: str, categories_str: str) -> Dict[str, str]:
+    """Обычный запрос для одной заметки (без склейки)."""
+    return _parse_result(await _call_openai(_build_request(text, categories_str)))
+
+
+# ==============================================
+#   Отложенный анализ через OpenAI Batch API
+# ==============================================
+
+BATCH_FLUSH_INTERVAL = 60.0   # сек между отправками пачек
+BATCH_MAX_ITEMS = 100         # отправить раньше, если набралось столько заметок
+BATCH_POLL_INTERVAL = 30.0    # сек между проверками статуса пачки
+BATCH_DOWNLOAD_ATTEMPTS = 5    # попыток скачать файл с результатами
+
+_BATCH_BUFFER: List[Dict] = []
+_batch_ready = asyncio.Event()
+_batch_pollers: set = set()
+
+BatchResultCallback = Callable[[int, Dict[str, str]], Awaitable[None]]
+
+
+async def analyze_note_deferred(
+    note_id: int,
+    text: str,
+    user_categories: Optional[Sequence[str]] = None
+) -> None:
+    """
+    Ставит заметку в очередь на анализ через Batch API (в 2 раза дешевле,
+    но результат приходит с задержкой). Результат отдаётся в колбэк run_batch_worker.
+    
+    Args:
+        note_id: ID уже сохранённой заметки (станет custom_id в пачке)
+        text: текст заметки
+        user_categories: существующие категории пользователя
+    """
+    _BATCH_BUFFER.append({
+        "custom_id": str(note_id),
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": _build_request(text, format_categories(user_categories)),
+    })
+    
+    if len(_BATCH_BUFFER) >= BATCH_MAX_ITEMS:
+        _batch_ready.set()
+
+
+async def run_batch_worker(on_result: BatchResultCallback) -> None:
+    """
+    Фоновая задача: раз в BATCH_FLUSH_INTERVAL (или при BATCH_MAX_ITEMS заметках)
+    отправляет накопленные заметки одной пачкой в Batch API.
+    
+    Args:
+        on_result: корутина (note_id, {"category", "description"}) — вызывается
+                   для каждой заметки, когда пачка обработана
+    """
+    while True:
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(_batch_ready.wait(), timeout=BATCH_FLUSH_INTERVAL)
+        _batch_ready.clear()
+        
+        if not _BATCH_BUFFER:
+            continue
+        
+        items = _BATCH_BUFFER[:]
+        _BATCH_BUFFER.clear()
+        
+        try:
+            batch_id = await _submit_batch(items)
+        except Exception as e:
+            logger.error("❌ Не удалось отправить пачку (%d заметок): %s", len(items), e, exc_info=True)
+            _BATCH_BUFFER[:0] = items  # вернём в очередь, попробуем в следующий раз
+            continue
+        
+        # Ждём результат в отдельной задаче, чтобы не блокировать следующие пачки
+        task = asyncio.create_task(_collect_batch(batch_id, on_result))
+        _batch_pollers.add(task)
+        task.add_done_callback(_batch_pollers.discard)
+
+
+async def stop_batch_pollers() -> None:
+    """
+    Останавливает ожидание отправленных пачек и очищает буфер (вызывается при остановке бота).
+
+    Заметки из буфера и незавершённых пачек остаются в БД без описания —
+    при следующем запуске они снова попадут в очередь (NotesRepo.list_pending_analysis),
+    поэтому отправлять буфер напоследок не нужно: результат этой пачки уже некому забрать.
+    """
+    if _BATCH_BUFFER:
+        logger.info("📦 %d заметок ждут анализа, отправим после перезапуска", len(_BATCH_BUFFER))
+        _BATCH_BUFFER.clear()
+
+    pollers = list(_batch_pollers)
+    for task in pollers:
+        task.cancel()
+    await asyncio.gather(*pollers, return_exceptions=True)
+
+
+async def _submit_batch(items: List[Dict]) -> str:
+    """
+    Загружает JSONL-файл с запросами и создаёт пачку. Возвращает ID пачки.
+    """
+    client = _get_client()
+    payload = b"\n".join(orjson.dumps(item) for item in items)
+    input_file = await client.files.create(file=("notes.jsonl", payload), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    logger.info("📦 Пачка %s отправлена: %d заметок", batch.id, len(items))
+    return batch.id
+
+
+async def _collect_batch(batch_id: str, on_result: BatchResultCallback) -> None:
+    """
+    Ждёт завершения пачки, скачивает результаты и отдаёт их в колбэк.
+    """
+    client = _get_client()
+    
+    while True:
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        try:
+            batch = await client.batches.retrieve(batch_id)
+        except Exception as e:
+            logger.warning("⚠️ Не удалось проверить пачку %s: %s", batch_id, e)
+            continue
+        
+        if batch.status == "completed":
+            break
+        if batch.status in ("failed", "expired", "cancelled"):
+            logger.error("❌ Пачка %s завершилась со статусом %s", batch_id, batch.status)
+            return
+    
+    if not batch.output_file_id:
+        logger.error("❌ Пачка %s не вернула результатов", batch_id)
+        return
+    
+    # Файл с результатами хранится у OpenAI — при сбое скачивания пробуем ещё раз
+    for attempt in range(1, BATCH_DOWNLOAD_ATTEMPTS + 1):
+        try:
+            content = await client.files.content(batch.output_file_id)
+            break
+        except Exception as e:
+            logger.warning(
+                "⚠️ Не удалось скачать результаты пачки %s (попытка %d/%d): %s",
+                batch_id, attempt, BATCH_DOWNLOAD_ATTEMPTS, e,
+            )
+            if attempt == BATCH_DOWNLOAD_ATTEMPTS:
+                logger.error("❌ Результаты пачки %s не получены", batch_id)
+                return
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+    
+    for line in content.text.splitlines():
+        if not line.strip():
+            continue
+        
+        note_id = None
+        try:
+            item = orjson.loads(line)
+            note_id = int(item["custom_id"])
+            response = item.get("response") or {}
+            
+            if response.get("status_code") != 200:
+                logger.error("❌ Заметка #%s не проанализирована: %s", note_id, item.get('error'))
+                continue
+            
+            response_text = response["body"]["choices"][0]["message"]["content"].strip()
+            result = _parse_result(response_text)
+            await on_result(note_id, result)
+        except Exception as e:
+            logger.error("❌ Ошибка при обработке результата заметки #%s: %s", note_id, e, exc_info=True)
+    
+    logger.info("✅ Пачка %s обработана", batch_id)
+
+
 # ==============================================
 #   Хелпер для проверки валидности категории
 # ==============================================
 
+# "ЭМОДЗИ название": что-то до первого пробела + хоть один символ после него
+_CATEGORY_RE = re.compile(r"[^ ]+ .", re.DOTALL)
+
+
 def is_valid_category(category: str) -> bool:
     """
     Проверяет, что категория имеет правильный формат.
@@ -263,23 +1019,38 @@ def is_valid_category(category: str) -> bool:
     Returns:
         True если категория валидна, False иначе
     """
-    # Проверяем, что есть пробел и что часть после пробела не пустая
-    if not category or " " not in category:
-        return False
-    
-    parts = category.split(" ", 1)
-    emoji_part = parts[0]
-    name_part = parts[1] if len(parts) > 1 else ""
-    
-    # Простая проверка: первый символ не ASCII буква/цифра (вероятно эмодзи)
-    # и есть название
-    return len(emoji_part) > 0 and len(name_part) > 0
+    # Непустая часть до первого пробела, затем непустое название
+    return bool(category) and _CATEGORY_RE.match(category) is not None
 
 
 # ==============================================
 #   Получение рекомендуемых категорий
 # ==============================================
 
+# Группа регулярки → (категория, ключевые слова). Порядок = порядок подсказок.
+_SUGGESTION_GROUPS: Tuple[Tuple[str, str, Tuple[str, ...]], ...] = (
+    ("shop", "🛒 Покупки", ("купи", "куп", "магаз", "продукт", "хлеб", "молок")),
+    ("idea", "💡 Идеи", ("идея", "думаю", "может", "хочу", "создать", "написать")),
+    ("recipe", "🍳 Рецепты", ("рецепт", "готовить", "блюдо", "приготов", "ингредиент")),
+    ("movie", "🎬 Фильмы", ("фильм", "кино", "сериал", "посмотр", "видео")),
+    ("book", "📚 Книги", ("книг", "читать", "прочит", "автор", "произведени")),
+    ("music", "🎵 Музыка", ("музык", "песн", "трек", "артист", "альбом", "композитор")),
+    ("anime", "📺 Аниме", ("аниме", "манга", "серия", "эпизод")),
+)
+
+_GROUP_TO_CATEGORY: Dict[str, str] = {group: cat for group, cat, _ in _SUGGESTION_GROUPS}
+_CATEGORY_ORDER: Dict[str, int] = {cat: i for i, (_, cat, _) in enumerate(_SUGGESTION_GROUPS)}
+
+# Один проход по тексту в C-движке re: по именованной группе на категорию.
+# Lookahead находит и перекрывающиеся вхождения — как проверка подстроки.
+_SUGGESTION_RE = re.compile(
+    "(?=" + "|".join(
+        f"(?P<{group}>" + "|".join(map(re.escape, words)) + ")"
+        for group, _, words in _SUGGESTION_GROUPS
+    ) + ")"
+)
+
+
 async def get_suggested_categories(text: str) -> List[str]:
     """
     Быстро предлагает несколько подходящих категорий на основе текста.
@@ -292,33 +1063,12 @@ async def get_suggested_categories(text: str) -> List[str]:
         список из 2-3 предложенных категорий
     """
     # Простая эвристика для быстрого определения
-    text_lower = text.lower()
-    
-    suggestions = []
-    
-    if any(word in text_lower for word in ["купи", "куп", "магаз", "продукт", "хлеб", "молок", "молоко"]):
-        suggestions.append("🛒 Покупки")
-    
-    if any(word in text_lower for word in ["идея", "думаю", "может", "хочу", "создать", "написать"]):
-        suggestions.append("💡 Идеи")
-    
-    if any(word in text_lower for word in ["рецепт", "готовить", "блюдо", "приготов", "ингредиент"]):
-        suggestions.append("🍳 Рецепты")
-    
-    if any(word in text_lower for word in ["фильм", "кино", "сериал", "посмотр", "видео"]):
-        suggestions.append("🎬 Фильмы")
-    
-    if any(word in text_lower for word in ["книг", "читать", "прочит", "автор", "произведени"]):
-        suggestions.append("📚 Книги")
-    
-    if any(word in text_lower for word in ["музык", "песн", "трек", "артист", "альбом", "композитор"]):
-        suggestions.append("🎵 Музыка")
-    
-    if any(word in text_lower for word in ["аниме", "манга", "серия", "эпизод"]):
-        suggestions.append("📺 Аниме")
+    found = set()
+    for m in _SUGGESTION_RE.finditer(text.lower()):
+        found.add(_GROUP_TO_CATEGORY[m.lastgroup])
     
-    # Если ничего не подошло или меньше 1 — добавим Прочее
-    if not suggestions:
-        suggestions.append("🎯 Прочее")
+    # Если ничего не подошло — добавим Прочее
+    if not found:
+        return ["🎯 Прочее"]
     
-    return suggestions[:3]  # Максимум 3 предложения
\ No newline at end of file
+    return sorted(found, key=_CATEGORY_ORDER.__getitem__)[:3]  # Максимум 3 предложения
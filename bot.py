@@ -1,42 +1,162 @@
 import asyncio
+import time
+from collections import OrderedDict
 from contextlib import suppress
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.utils import executor
-from aiogram.types import (ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery)
+from aiogram.types import (ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery)
 
 from config import get_settings
-from logging_conf import setup_logging
-from db.base import init_db, Base
+from logging_conf import setup_logging, stop_logging
+from db.base import init_db, warmup_pool, Base
 from db.repositories import UsersRepo, NotesRepo
 from db.models import Note  # ← нужно для handle_note_selection
 from middlewares.traffic import TrafficLogMiddleware
 from middlewares.auto_delete import AutoDeleteCommandsMiddleware
-from ai_service import init_openai, analyze_note  # ← НОВОЕ
+from state import MemoryState, create_state
+from ai_service import (
+    init_openai,
+    close_openai,
+    analyze_note,
+    analyze_note_deferred,
+    format_categories,
+    get_suggested_categories,
+    run_batch_worker,
+    run_coalesce_worker,
+    stop_batch_pollers,
+)
+
+# uvloop вместо стандартного цикла событий — ставим до создания Bot и executor.
+# На Windows uvloop нет — там остаётся стандартный цикл.
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+else:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 settings = get_settings()
 logger = setup_logging(settings.env)
 
-LAST_REPLY: Dict[int, int] = {}
-EDITING_STATE: Dict[int, int] = {}
+# Состояние между апдейтами: последний ответ бота в чате и редактируемая заметка.
+# По умолчанию в памяти, при REDIS_URL — в Redis (подменяется в on_startup).
+state = MemoryState()
+
+LAST_REPLY_TTL = 48 * 60 * 60   # Telegram даёт удалять сообщения бота 48 часов
+EDITING_TTL = 5 * 60            # незавершённое редактирование забываем через 5 минут
+
+async def remember_reply(chat_id: int, message_id: int) -> None:
+    await state.set(f"lr:{chat_id}", message_id, LAST_REPLY_TTL)
 
 # Глобальные экземпляры репозиториев (инициализируются в on_startup)
 users_repo: Optional[UsersRepo] = None
 notes_repo: Optional[NotesRepo] = None
 
+# Фоновая задача отправки пачек в Batch API (только при AI_BATCH_MODE)
+batch_worker: Optional[asyncio.Task] = None
+# Фоновая задача склейки одновременных заметок (только при AI_COALESCE)
+coalesce_worker: Optional[asyncio.Task] = None
+
+# Фоновые users_repo.ensure: храним ссылки, чтобы задачи не собрал GC
+_BG_TASKS: set = set()
+
+def _ensure_done(task: asyncio.Task) -> None:
+    _BG_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("❌ Ошибка при сохранении пользователя: %s", task.exception(), exc_info=task.exception())
+
+def _ensure_user(user: types.User) -> asyncio.Task:
+    """
+    Запускает users_repo.ensure в фоне — ответ пользователю его не ждёт.
+    Ошибки логируются в done-callback.
+    """
+    task = asyncio.create_task(users_repo.ensure(user.id, user.username))
+    _BG_TASKS.add(task)
+    task.add_done_callback(_ensure_done)
+    return task
+
+async def _user_categories(user_id: int) -> Tuple[Tuple[str, ...], str]:
+    """
+    Категории пользователя для ИИ-анализа и собранный из них блок промпта.
+    Категории берутся из кэша NotesRepo (тот же GROUP BY, что и кнопки архива),
+    блок промпта format_categories запоминает по самому списку категорий.
+    """
+    rows = await notes_repo.get_all_categories(user_id)
+    user_categories = tuple(category for category, _ in rows if category is not None)
+    return user_categories, format_categories(user_categories)
+
+# Отрисованный список категорий в state (сами категории кэширует NotesRepo).
+# Сбрасывается при создании, редактировании и удалении заметок.
+CATEGORIES_VIEW_TTL = 60
+
+async def _forget_categories(user_id: int) -> None:
+    """Сбрасывает отрисованный список категорий (cats:<user_id>)."""
+    await state.delete(f"cats:{user_id}")
+
+# Недавно открытые заметки: note_id → (время, user_id, текст, категория).
+# Кнопки "Редактировать" / "Удалить" берут данные отсюда, без похода в БД.
+RECENT_NOTES_TTL = 300.0
+RECENT_NOTES_MAX = 10000
+_RECENT_NOTES: "OrderedDict[int, Tuple[float, int, str, Optional[str]]]" = OrderedDict()
+
+def _remember_note(note: Note) -> None:
+    _RECENT_NOTES[note.id] = (time.monotonic(), note.user_id, note.text, note.category)
+    _RECENT_NOTES.move_to_end(note.id)
+    if len(_RECENT_NOTES) > RECENT_NOTES_MAX:
+        _RECENT_NOTES.popitem(last=False)
+
+async def _note_brief(note_id: int, user_id: int) -> Optional[Tuple[str, Optional[str]]]:
+    """
+    (текст, категория) заметки, если она существует и принадлежит user_id.
+    Сначала смотрим в _RECENT_NOTES, при промахе — в БД.
+    """
+    cached = _RECENT_NOTES.get(note_id)
+    if cached and time.monotonic() - cached[0] < RECENT_NOTES_TTL:
+        if cached[1] != user_id:
+            return None
+        return cached[2], cached[3]
+    
+    note = await notes_repo.get_owned(note_id, user_id)
+    if not note:
+        return None
+    _remember_note(note)
+    return note.text, note.category
+
+def _status_updater(status_msg: types.Message):
+    """
+    Колбэк для analyze_note: показывает категорию в статус-сообщении,
+    пока модель ещё дописывает описание.
+    """
+    async def on_category(category: str) -> None:
+        with suppress(Exception):
+            await status_msg.edit_text(f"⏳ Анализ...\n<b>Категория:</b> {category}")
+    return on_category
+
+async def _safe_delete(chat_id: int, message_id: int) -> None:
+    # удаление сообщения, которое могло уже исчезнуть — ошибки не важны
+    with suppress(Exception):
+        await bot.delete_message(chat_id, message_id)
+
 async def delete_last_reply(chat_id: int) -> None:
-    msg_id: Optional[int] = LAST_REPLY.get(chat_id)
+    msg_id: Optional[int] = await state.pop(f"lr:{chat_id}")
     if msg_id:
-        with suppress(Exception):
-            await bot.delete_message(chat_id, msg_id)
-        LAST_REPLY.pop(chat_id, None)
+        await _safe_delete(chat_id, msg_id)
 
 def _norm(text: str) -> str:
     # нормализуем текст кнопки: нижний регистр + без лишних пробелов
     return (text or "").strip().casefold()
 
-bot = Bot(token=settings.bot_token, parse_mode=types.ParseMode.HTML)
+def _valid_note(t: str) -> bool:
+    """Допустимая длина заметки: 3-60 символов."""
+    return 3 <= len(t) <= 60
+
+# Все запросы идут на один хост api.telegram.org через одну сессию aiohttp
+# (создаётся лениво при первом запросе). aiogram 2 не принимает готовый
+# connector, поэтому дополняем параметры, с которыми он его создаст.
+bot = Bot(token=settings.bot_token, parse_mode=types.ParseMode.HTML, connections_limit=200)
+bot._connector_init.update(limit_per_host=100, ttl_dns_cache=300, keepalive_timeout=75)
 dp = Dispatcher(bot)
 
 dp.middleware.setup(TrafficLogMiddleware(
@@ -50,25 +170,93 @@ MAIN_KB.add(KeyboardButton("🗂️ Архив"))
 MAIN_KB.add(KeyboardButton("❓ Помощь"))
 
 
+# ===== TEXTS =====
+
+HELP_TEXT = (
+    "ℹ️ Раздел помощи.\n"
+    "Для сохранения заметки просто напиши ее в чат (3-60 символов)\n"
+    "Я автоматически ее проанализирую,\n"
+    "добавлю больше информации к ней и\n"
+    "присвою ей категорию.\n"
+    "Позже ты можешь добавить контекст и сказать мне дополнить информацию"
+)
+CATEGORIES_HEADER = "📂 Твои категории:\n\nВыбери категорию, чтобы посмотреть заметки"
+NO_NOTES_TEXT = "📂 У тебя пока нет заметок.\n\nПросто напиши текст (3-60 символов), и я сохраню его!"
+
+
+# ===== KEYBOARDS =====
+
+def _categories_keyboard(categories) -> InlineKeyboardMarkup:
+    # по 1 кнопке в ряд: "🛒 Покупки (5)" → "cat_🛒 Покупки"
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{category} ({count})", callback_data=f"cat_{category}")]
+        for category, count in categories
+    ])
+
+def _categories_view(categories) -> list:
+    # [текст, JSON клавиатуры]: клавиатура сериализуется один раз здесь,
+    # а строка из кэша уходит в API как есть (aiogram не кодирует её повторно)
+    if not categories:
+        return [NO_NOTES_TEXT, None]
+    return [CATEGORIES_HEADER, _categories_keyboard(categories).as_json()]
+
+def _label(text: str, limit: int = 35) -> str:
+    # обрезаем текст для кнопки; "…" — один символ вместо трёх точек
+    return text if len(text) <= limit else text[:limit] + "…"
+
+# Кнопка одинакова для всех списков заметок — создаём один раз
+_BACK_TO_CATEGORIES = InlineKeyboardButton("⬅️ Назад к категориям", callback_data="back_to_categories")
+
+def _notes_keyboard(notes) -> InlineKeyboardMarkup:
+    # заметки категории (текст обрезан, чтобы не было длинных кнопок) + "Назад"
+    rows = [
+        [InlineKeyboardButton(text=_label(note.text), callback_data=f"note_{note.id}")]
+        for note in notes
+    ]
+    rows.append([_BACK_TO_CATEGORIES])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
 # ===== STARTUP / SHUTDOWN HANDLERS =====
 
+async def _create_tables(engine) -> None:
+    """Создаёт все таблицы (если их ещё нет)."""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
 async def on_startup(dispatcher):
     """
     Инициализация БД и создание таблиц при запуске бота.
     """
-    global users_repo, notes_repo
+    global users_repo, notes_repo, batch_worker, coalesce_worker, state
     
     logger.info("🚀 Запуск бота...")
-    logger.info(f"📝 Подключение к БД: {settings.db_url}")
+    logger.info("📝 Подключение к БД: %s", settings.db_url)
     
     try:
         # ← НОВОЕ: Инициализируем OpenAI API
-        init_openai(settings.openai_api_key)
+        init_openai(
+            settings.openai_api_key,
+            settings.semantic_cache_threshold,
+            max_concurrency=settings.openai_max_concurrency,
+            rpm_limit=settings.openai_rpm_limit,
+        )
         logger.info("✅ OpenAI API инициализирован")
         
+        if settings.redis_url:
+            state = create_state(settings.redis_url)
+            logger.info("✅ Состояние хранится в Redis")
+        
         # Инициализируем БД (создаём engine и sessionmaker)
         # init_db устанавливает глобальные переменные async_engine и async_session
-        async_session_maker = await init_db(settings.db_url)
+        async_session_maker = await init_db(
+            settings.db_url,
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+            pool_recycle=settings.db_pool_recycle,
+        )
         logger.info("✅ Engine и SessionMaker инициализированы")
         
         # Импортируем engine из db.base (он был установлен в init_db)
@@ -76,18 +264,26 @@ async def on_startup(dispatcher):
         if engine is None:
             raise RuntimeError("❌ Engine не инициализирован после init_db()")
         
-        # Создаём все таблицы (если их ещё нет)
-        async with engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
-        logger.info("✅ Таблицы созданы / уже существуют")
+        # Создаём таблицы и прогреваем пул параллельно — шаги независимы
+        await asyncio.gather(_create_tables(engine), warmup_pool(settings.db_pool_size))
+        logger.info("✅ Таблицы созданы / уже существуют, пул соединений прогрет")
         
         # Создаём экземпляры репозиториев
         users_repo = UsersRepo(async_session_maker)
         notes_repo = NotesRepo(async_session_maker)
         logger.info("✅ Репозитории инициализированы")
         
+        if settings.ai_batch_mode:
+            batch_worker = asyncio.create_task(run_batch_worker(apply_deferred_analysis))
+            logger.info("✅ Отложенный анализ через Batch API включён")
+            await _requeue_pending_analysis()
+        
+        if settings.ai_coalesce:
+            coalesce_worker = asyncio.create_task(run_coalesce_worker())
+            logger.info("✅ Склейка одновременных заметок включена")
+        
     except Exception as e:
-        logger.error(f"❌ Ошибка при инициализации БД: {e}", exc_info=True)
+        logger.error("❌ Ошибка при инициализации БД: %s", e, exc_info=True)
         raise
 
 
@@ -96,103 +292,143 @@ async def on_shutdown(dispatcher):
     Закрытие соединения с БД при остановке бота.
     """
     logger.info("🛑 Остановка бота...")
+    if batch_worker:
+        batch_worker.cancel()
+        with suppress(asyncio.CancelledError):
+            await batch_worker
+        await stop_batch_pollers()
+    if coalesce_worker:
+        coalesce_worker.cancel()
+        with suppress(asyncio.CancelledError):
+            await coalesce_worker
+    await close_openai()
+    await state.close()
     try:
         from db.base import async_engine as engine
         if engine:
             await engine.dispose()
             logger.info("✅ БД отключена")
     except Exception as e:
-        logger.error(f"⚠️ Ошибка при отключении БД: {e}")
+        logger.error("⚠️ Ошибка при отключении БД: %s", e)
+    stop_logging()
+
+
+async def _requeue_pending_analysis() -> None:
+    """
+    Ставит в очередь Batch API заметки, которые остались без описания
+    с прошлого запуска (буфер и ожидание пачек живут только в памяти).
+    """
+    pending = await notes_repo.list_pending_analysis()
+    for note_id, user_id, text in pending:
+        user_categories, _ = await _user_categories(user_id)
+        await analyze_note_deferred(note_id, text, user_categories)
+    if pending:
+        logger.info("📦 %d заметок снова поставлены на отложенный анализ", len(pending))
+
+
+async def apply_deferred_analysis(note_id: int, ai_result: Dict[str, str]) -> None:
+    """
+    Колбэк Batch API: сохраняет точную категорию и описание,
+    затем присылает пользователю дополненную заметку.
+    """
+    if not notes_repo:
+        return
+    
+    note = await notes_repo.update_analysis(note_id, ai_result["category"], ai_result["description"])
+    if not note:
+        # Заметку удалили или уже отредактировали — результат устарел
+        return
+    _RECENT_NOTES.pop(note_id, None)
+    
+    await _forget_categories(note.user_id)
+    logger.info("🧠 Заметка #%s дополнена: %s", note_id, note.category)
+    
+    with suppress(Exception):
+        await bot.send_message(
+            note.user_id,
+            f"🧠 Заметка дополнена!\n\n"
+            f"<b>Текст:</b> {note.text}\n"
+            f"<b>Категория:</b> {note.category}\n"
+            f"<b>Описание:</b> {note.description}"
+        )
 
 
 # ===== HANDLERS =====
 
+async def _send_categories(target: types.Message, user_id: int, edit: bool = False):
+    """
+    Показывает список категорий пользователя: отправляет новое сообщение
+    или (edit=True) редактирует target. Если заметок нет — подсказка.
+    Готовые текст и клавиатура кэшируются в state (общем при Redis),
+    так что всплеск нажатий "Архив" не превращается в поток GROUP BY.
+    При промахе категории читаются из БД в обход кэша NotesRepo: он живёт
+    в процессе и может отставать от изменений, сделанных другим процессом.
+    """
+    key = f"cats:{user_id}"
+    cached = await state.get_json(key)
+    if cached is None:
+        cached = _categories_view(await notes_repo.get_all_categories(user_id, fresh=True))
+        await state.set_json(key, cached, CATEGORIES_VIEW_TTL)
+    text, keyboard = cached
+    
+    if edit:
+        return await target.edit_text(text, reply_markup=keyboard)
+    return await target.answer(text, reply_markup=keyboard)
+
+
 @dp.message_handler(commands=["start"])
 async def on_start(message: types.Message):
     # Добавляем пользователя в БД (если его ещё нет)
     if users_repo:
-        await users_repo.ensure(message.from_user.id, message.from_user.username)
-        logger.info(f"👤 Пользователь {message.from_user.id} (@{message.from_user.username}) начал работу с ботом")
+        _ensure_user(message.from_user)
+        logger.info("👤 Пользователь %s (@%s) начал работу с ботом", message.from_user.id, message.from_user.username)
     
     await message.answer(
         "\u2060",
         reply_markup=MAIN_KB
     )
 
-@dp.message_handler(lambda m: (m.text or "").lower() in {"❓ помощь", "помощь"})
 async def show_help(message: types.Message):
-    await delete_last_reply(message.chat.id)
-    sent = await message.answer(
-        "ℹ️ Раздел помощи.\n"
-        "Для сохранения заметки просто напиши ее в чат (3-60 символов)\n"
-        "Я автоматически ее проанализирую,\n"
-        "добавлю больше информации к ней и\n"
-        "присвою ей категорию.\n"
-        "Позже ты можешь добавить контекст и сказать мне дополнить информацию"
+    # старый ответ удаляем параллельно с отправкой нового
+    _, sent = await asyncio.gather(
+        delete_last_reply(message.chat.id),
+        message.answer(HELP_TEXT),
     )
-    LAST_REPLY[message.chat.id] = sent.message_id
+    await remember_reply(message.chat.id, sent.message_id)
 
 
 # ← НОВОЕ: Хендлер для просмотра категорий
-@dp.message_handler(lambda m: (m.text or "").lower() in {"🗂️ архив", "архив"})
 async def show_categories(message: types.Message):
     """
     Показывает список категорий с inline-кнопками.
     Каждая кнопка ведёт к заметкам этой категории.
     """
-    await delete_last_reply(message.chat.id)
-    
     if not notes_repo:
+        await delete_last_reply(message.chat.id)
         sent = await message.answer("⚠️ Ошибка: БД недоступна")
-        LAST_REPLY[message.chat.id] = sent.message_id
+        await remember_reply(message.chat.id, sent.message_id)
         return
     
     try:
-        # Получаем все категории пользователя
-        categories = await notes_repo.get_all_categories(message.from_user.id)
-        
-        if not categories:
-            # Если заметок нет — показываем подсказку
-            sent = await message.answer(
-                "📂 У тебя пока нет заметок.\n\n"
-                "Просто напиши текст (3-60 символов), и я сохраню его!"
-            )
-            LAST_REPLY[message.chat.id] = sent.message_id
-            return
-        
-        # Создаём inline-клавиатуру
-        keyboard = InlineKeyboardMarkup(row_width=1)  # по 1 кнопке в ряд
-        
-        for category, count in categories:
-            # Добавляем кнопку для каждой категории
-            keyboard.add(
-                InlineKeyboardButton(
-                    text=f"{category} ({count})",  # "🛒 Покупки (5)"
-                    callback_data=f"cat_{category}"  # "cat_🛒 Покупки"
-                )
-            )
-        
-        sent = await message.answer(
-            "📂 Твои категории:\n\n"
-            "Выбери категорию, чтобы посмотреть заметки",
-            reply_markup=keyboard  # ← кнопки прикрепляются к сообщению
+        # старый ответ удаляем параллельно с отправкой списка категорий
+        _, sent = await asyncio.gather(
+            delete_last_reply(message.chat.id),
+            _send_categories(message, message.from_user.id),
         )
-        
-        LAST_REPLY[message.chat.id] = sent.message_id
+        await remember_reply(message.chat.id, sent.message_id)
         
     except Exception as e:
-        logger.error(f"❌ Ошибка при получении категорий: {e}", exc_info=True)
+        logger.error("❌ Ошибка при получении категорий: %s", e, exc_info=True)
         await message.answer("❌ Ошибка. Попробуй ещё раз.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("cat_"))
-async def handle_category_selection(callback: CallbackQuery):
+async def handle_category_selection(callback: CallbackQuery, payload: str):
     """
     Обрабатывает нажатие на кнопку категории.
     Показывает список заметок выбранной категории.
     """
-    # Извлекаем название категории из callback_data
+    # Название категории из callback_data
     # Пример: "cat_🛒 Покупки" → "🛒 Покупки"
-    category = callback.data[4:]  # убираем первые 4 символа ("cat_")
+    category = payload
     
     if not notes_repo:
         await callback.answer("⚠️ Ошибка: БД недоступна", show_alert=True)
@@ -210,27 +446,8 @@ async def handle_category_selection(callback: CallbackQuery):
         await callback.answer("📭 В этой категории пока нет заметок", show_alert=True)
         return
     
-    # Создаём клавиатуру с заметками
-    keyboard = InlineKeyboardMarkup(row_width=1)
-    
-    for note in notes:
-        # Обрезаем текст для кнопки (чтобы не было длинных кнопок)
-        button_text = note.text[:35] + "..." if len(note.text) > 35 else note.text
-        
-        keyboard.add(
-            InlineKeyboardButton(
-                text=button_text,  # "купить молоко и хлеб"
-                callback_data=f"note_{note.id}"  # "note_123"
-            )
-        )
-    
-    # Кнопка "Назад к категориям"
-    keyboard.add(
-        InlineKeyboardButton(
-            "⬅️ Назад к категориям", 
-            callback_data="back_to_categories"
-        )
-    )
+    # Создаём клавиатуру с заметками и кнопкой "Назад к категориям"
+    keyboard = _notes_keyboard(notes)
     
     # Редактируем сообщение (вместо отправки нового)
     await callback.message.edit_text(
@@ -243,27 +460,24 @@ async def handle_category_selection(callback: CallbackQuery):
     # Убираем "часики" на кнопке
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("note_"))
-async def handle_note_selection(callback: CallbackQuery):
+async def handle_note_selection(callback: CallbackQuery, payload: str):
     """
     Показывает детали выбранной заметки.
     """
-    # Извлекаем ID заметки из callback_data
+    # ID заметки из callback_data
     # Пример: "note_123" → 123
-    note_id = int(callback.data.split("_")[1])
+    note_id = int(payload)
     
     if not notes_repo:
         await callback.answer("⚠️ Ошибка: БД недоступна", show_alert=True)
         return
     
-    # Получаем заметку из БД
-    async with notes_repo.sm() as s:
-        note = await s.get(Note, note_id)
-        
-        # Проверка безопасности: заметка существует и принадлежит пользователю
-        if not note or note.user_id != callback.from_user.id:
-            await callback.answer("❌ Заметка не найдена", show_alert=True)
-            return
+    # Получаем заметку из БД (только если она принадлежит пользователю)
+    note = await notes_repo.get_owned(note_id, callback.from_user.id)
+    if not note:
+        await callback.answer("❌ Заметка не найдена", show_alert=True)
+        return
+    _remember_note(note)
     
     # Формируем детали заметки
     details = (
@@ -288,8 +502,7 @@ async def handle_note_selection(callback: CallbackQuery):
     await callback.message.edit_text(details, reply_markup=action_menu)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_categories")
-async def back_to_categories(callback: CallbackQuery):
+async def back_to_categories(callback: CallbackQuery, payload: str = ""):
     """
     Возвращает пользователя к списку категорий.
     """
@@ -297,151 +510,93 @@ async def back_to_categories(callback: CallbackQuery):
         await callback.answer("⚠️ Ошибка: БД недоступна", show_alert=True)
         return
     
-    # Получаем категории снова
-    categories = await notes_repo.get_all_categories(callback.from_user.id)
-    
-    if not categories:
-        await callback.message.edit_text("📂 У тебя пока нет заметок")
-        await callback.answer()
-        return
-    
-    # Создаём клавиатуру
-    keyboard = InlineKeyboardMarkup(row_width=1)
-    
-    for category, count in categories:
-        keyboard.add(
-            InlineKeyboardButton(
-                text=f"{category} ({count})",
-                callback_data=f"cat_{category}"
-            )
-        )
-    
-    await callback.message.edit_text(
-        "📂 Твои категории:\n\n"
-        "Выбери категорию, чтобы посмотреть заметки",
-        reply_markup=keyboard
-    )
-    
+    await _send_categories(callback.message, callback.from_user.id, edit=True)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("delete_"))
-async def handle_delete_note(callback: CallbackQuery):
+async def handle_delete_note(callback: CallbackQuery, payload: str):
     """
     Удаляет заметку после подтверждения.
     Показывает кнопки "Да, удалить" и "Отмена".
     """
-    # Извлекаем ID заметки
-    note_id = int(callback.data.split("_")[1])
+    # ID заметки: "delete_123" → 123
+    note_id = int(payload)
     
     if not notes_repo:
         await callback.answer("⚠️ Ошибка: БД недоступна", show_alert=True)
         return
     
-    # Получаем заметку для проверки прав
-    async with notes_repo.sm() as s:
-        note = await s.get(Note, note_id)
-        
-        if not note or note.user_id != callback.from_user.id:
-            await callback.answer("❌ Заметка не найдена", show_alert=True)
-            return
+    # Получаем заметку для проверки прав (обычно — из _RECENT_NOTES)
+    brief = await _note_brief(note_id, callback.from_user.id)
+    if brief is None:
+        await callback.answer("❌ Заметка не найдена", show_alert=True)
+        return
+    note_text, note_category = brief
     
     # Создаём меню подтверждения
     confirm_menu = InlineKeyboardMarkup(row_width=2)
     confirm_menu.add(
         InlineKeyboardButton("✅ Да, удалить", callback_data=f"confirm_delete_{note_id}"),
-        InlineKeyboardButton("❌ Отмена", callback_data=f"cat_{note.category}")
+        InlineKeyboardButton("❌ Отмена", callback_data=f"cat_{note_category}")
     )
     
     # Показываем предупреждение
     await callback.message.edit_text(
         f"🗑 <b>Удалить заметку?</b>\n\n"
-        f"<b>Текст:</b> {note.text}\n\n"
+        f"<b>Текст:</b> {note_text}\n\n"
         f"Это действие нельзя отменить.",
         reply_markup=confirm_menu
     )
     
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("confirm_delete_"))
-async def handle_confirm_delete(callback: CallbackQuery):
+async def handle_confirm_delete(callback: CallbackQuery, payload: str):
     """
     Окончательно удаляет заметку и возвращает к категории.
     """
-    # Извлекаем ID
-    note_id = int(callback.data.split("_")[2])  # "confirm_delete_123" → "123"
+    # ID: "confirm_delete_123" → payload "delete_123" → 123
+    note_id = int(payload.partition("_")[2])
     
     if not notes_repo:
         await callback.answer("⚠️ Ошибка: БД недоступна", show_alert=True)
         return
     
     try:
-        # Получаем заметку (нужна категория для возврата)
-        async with notes_repo.sm() as s:
-            note = await s.get(Note, note_id)
-            
-            if not note or note.user_id != callback.from_user.id:
-                await callback.answer("❌ Заметка не найдена", show_alert=True)
-                return
-            
-            # Сохраняем категорию до удаления
-            category = note.category
-            
-            # Удаляем заметку
-            await s.delete(note)
-            await s.commit()
+        # Удаляем заметку одним запросом (категория нужна для возврата)
+        deleted = await notes_repo.delete_returning_category(note_id, callback.from_user.id)
+        _RECENT_NOTES.pop(note_id, None)
+        
+        if deleted is None:
+            await callback.answer("❌ Заметка не найдена", show_alert=True)
+            return
+        
+        category = deleted.category
         
-        logger.info(f"🗑 Заметка #{note_id} удалена пользователем {callback.from_user.id}")
+        logger.info("🗑 Заметка #%s удалена пользователем %s", note_id, callback.from_user.id)
         
         # Показываем уведомление
         await callback.answer("✅ Заметка удалена", show_alert=True)
         
-        # Возвращаемся к списку заметок категории
-        # (копируем логику из handle_category_selection)
-        notes = await notes_repo.list_by_category(
+        # Одной сессией получаем оставшиеся заметки категории и список категорий
+        # (он понадобится, если это была последняя заметка) — и сразу кладём его в кэш
+        categories, notes = await notes_repo.categories_and_notes(
             user_id=callback.from_user.id,
             category=category,
             limit=20
         )
+        view = _categories_view(categories)
+        await state.set_json(f"cats:{callback.from_user.id}", view, CATEGORIES_VIEW_TTL)
         
         if not notes:
             # Если это была последняя заметка — возвращаемся к категориям
-            categories = await notes_repo.get_all_categories(callback.from_user.id)
-            
             if not categories:
                 await callback.message.edit_text("📂 У тебя больше нет заметок")
                 return
             
-            keyboard = InlineKeyboardMarkup(row_width=1)
-            for cat, count in categories:
-                keyboard.add(
-                    InlineKeyboardButton(
-                        text=f"{cat} ({count})",
-                        callback_data=f"cat_{cat}"
-                    )
-                )
-            
-            await callback.message.edit_text(
-                "📂 Твои категории:\n\n"
-                "Выбери категорию, чтобы посмотреть заметки",
-                reply_markup=keyboard
-            )
+            await callback.message.edit_text(view[0], reply_markup=view[1])
             return
         
         # Показываем оставшиеся заметки категории
-        keyboard = InlineKeyboardMarkup(row_width=1)
-        
-        for n in notes:
-            button_text = n.text[:35] + "..." if len(n.text) > 35 else n.text
-            keyboard.add(
-                InlineKeyboardButton(
-                    text=button_text,
-                    callback_data=f"note_{n.id}"
-                )
-            )
-        
-        keyboard.add(
-            InlineKeyboardButton("⬅️ Назад к категориям", callback_data="back_to_categories")
-        )
+        keyboard = _notes_keyboard(notes)
         
         await callback.message.edit_text(
             f"📂 {category}\n\n"
@@ -451,29 +606,27 @@ async def handle_confirm_delete(callback: CallbackQuery):
         )
         
     except Exception as e:
-        logger.error(f"❌ Ошибка при удалении заметки: {e}", exc_info=True)
+        logger.error("❌ Ошибка при удалении заметки: %s", e, exc_info=True)
         await callback.answer("❌ Ошибка при удалении", show_alert=True)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_"))
-async def handle_edit_note(callback: CallbackQuery):
+async def handle_edit_note(callback: CallbackQuery, payload: str):
     """
     Начинает процесс редактирования заметки.
     Просит пользователя отправить новый текст.
     """
-    # Извлекаем ID заметки
-    note_id = int(callback.data.split("_")[1])
+    # ID заметки: "edit_123" → 123
+    note_id = int(payload)
     
     if not notes_repo:
         await callback.answer("⚠️ Ошибка: БД недоступна", show_alert=True)
         return
     
-    # Получаем заметку
-    async with notes_repo.sm() as s:
-        note = await s.get(Note, note_id)
-        
-        if not note or note.user_id != callback.from_user.id:
-            await callback.answer("❌ Заметка не найдена", show_alert=True)
-            return
+    # Получаем заметку (обычно — из _RECENT_NOTES)
+    brief = await _note_brief(note_id, callback.from_user.id)
+    if brief is None:
+        await callback.answer("❌ Заметка не найдена", show_alert=True)
+        return
+    note_text, _ = brief
     
     # Создаём меню отмены
     cancel_menu = InlineKeyboardMarkup()
@@ -484,18 +637,38 @@ async def handle_edit_note(callback: CallbackQuery):
     # Просим ввести новый текст
     await callback.message.edit_text(
         f"✏️ <b>Редактирование заметки #{note_id}</b>\n\n"
-        f"<b>Текущий текст:</b> {note.text}\n\n"
+        f"<b>Текущий текст:</b> {note_text}\n\n"
         f"Отправь новый текст заметки (3-60 символов):",
         reply_markup=cancel_menu
     )
     
     # Сохраняем состояние: пользователь редактирует заметку
     # (используем глобальный словарь для хранения состояния)
-    EDITING_STATE[callback.from_user.id] = note_id
+    await state.set(f"es:{callback.from_user.id}", note_id, EDITING_TTL)
     
     await callback.answer()            
 
-@dp.message_handler(content_types=[types.ContentType.TEXT])
+# Все inline-кнопки обрабатывает один хендлер: префикс callback_data до
+# первого "_" → функция, остаток передаётся ей как payload.
+# Формат callback_data не меняем — кнопки в старых сообщениях продолжают работать.
+CALLBACK_HANDLERS = {
+    "cat": handle_category_selection,      # cat_<категория>
+    "note": handle_note_selection,         # note_<id>
+    "delete": handle_delete_note,          # delete_<id>
+    "confirm": handle_confirm_delete,      # confirm_delete_<id>
+    "edit": handle_edit_note,              # edit_<id>
+    "back": back_to_categories,            # back_to_categories
+}
+
+@dp.callback_query_handler()
+async def route_callback(callback: CallbackQuery):
+    prefix, _, payload = (callback.data or "").partition("_")
+    handler = CALLBACK_HANDLERS.get(prefix)
+    if handler is None:
+        await callback.answer()
+        return
+    await handler(callback, payload)
+
 async def handle_note(message: types.Message):
     """
     Обработка текстовых сообщений:
@@ -507,13 +680,13 @@ async def handle_note(message: types.Message):
     # ========================================
     # Проверяем: это редактирование?
     # ========================================
-    if message.from_user.id in EDITING_STATE:
-        note_id = EDITING_STATE.pop(message.from_user.id)
+    note_id = await state.pop(f"es:{message.from_user.id}")
+    if note_id is not None:
         
         # Проверяем длину нового текста
-        if len(text) < 3 or len(text) > 60:
+        if not _valid_note(text):
             # Возвращаем состояние редактирования
-            EDITING_STATE[message.from_user.id] = note_id
+            await state.set(f"es:{message.from_user.id}", note_id, EDITING_TTL)
             await message.reply("❌ Текст должен быть от 3 до 60 символов. Попробуй ещё раз!")
             return
         
@@ -523,102 +696,133 @@ async def handle_note(message: types.Message):
                 await message.reply("⚠️ Ошибка: БД недоступна")
                 return
             
-            async with notes_repo.sm() as s:
-                note = await s.get(Note, note_id)
-                
-                if not note or note.user_id != message.from_user.id:
-                    await message.reply("❌ Заметка не найдена")
-                    return
-                
-                # Показываем статус
-                status_msg = await message.reply("⏳ Анализ нового текста...")
-                
-                # Получаем категории для ИИ
-                existing_categories = await notes_repo.get_all_categories(message.from_user.id)
-                user_categories = [cat for cat, _ in existing_categories] if existing_categories else []
-                user_categories = [cat for cat in user_categories if cat is not None]
-                
-                # Анализируем новый текст
-                ai_result = await analyze_note(text, user_categories)
-                new_category = ai_result.get("category", "🎯 Прочее")
-                new_description = ai_result.get("description", "")
-                
-                # Обновляем поля
-                old_text = note.text
-                note.text = text
-                note.category = new_category
-                note.description = new_description
-                
-                await s.commit()
-                
-                # Удаляем статус
-                with suppress(Exception):
-                    await bot.delete_message(message.chat.id, status_msg.message_id)
-                
-                logger.info(f"✏️ Заметка #{note_id} обновлена: '{old_text}' → '{text}'")
-                
-                # Показываем результат с кнопкой возврата
-                result_menu = InlineKeyboardMarkup()
-                result_menu.add(
-                    InlineKeyboardButton("📝 Открыть заметку", callback_data=f"note_{note_id}")
-                )
-                
-                await message.reply(
-                    f"✅ Заметка обновлена!\n\n"
-                    f"<b>Новый текст:</b> {text}\n"
-                    f"<b>Категория:</b> {new_category}\n"
-                    f"<b>Описание:</b> {new_description}",
-                    reply_markup=result_menu
+            # Проверяем владельца, показываем статус и получаем категории для ИИ —
+            # параллельно; сессия БД не держится открытой во время запроса к ИИ
+            brief, status_msg, (user_categories, categories_str) = await asyncio.gather(
+                _note_brief(note_id, message.from_user.id),
+                message.reply("⏳ Анализ нового текста..."),
+                _user_categories(message.from_user.id),
+            )
+            
+            if brief is None:
+                await asyncio.gather(
+                    _safe_delete(message.chat.id, status_msg.message_id),
+                    message.reply("❌ Заметка не найдена"),
                 )
-                
-                return  # ← ВАЖНО! Выходим, чтобы не создавать новую заметку
+                return
+            old_text = brief[0]
+            
+            # Анализируем новый текст
+            ai_result = await analyze_note(
+                text, user_categories, message.from_user.id, _status_updater(status_msg),
+                categories_str=categories_str
+            )
+            new_category = ai_result.get("category", "🎯 Прочее")
+            new_description = ai_result.get("description", "")
+            
+            # Обновляем заметку одним UPDATE и одновременно удаляем статус
+            updated, _ = await asyncio.gather(
+                notes_repo.update_note(note_id, message.from_user.id, text, new_category, new_description),
+                _safe_delete(message.chat.id, status_msg.message_id),
+            )
+            _RECENT_NOTES.pop(note_id, None)
+            if not updated:
+                # Заметку удалили, пока шёл анализ
+                await message.reply("❌ Заметка не найдена")
+                return
+            await _forget_categories(message.from_user.id)
+            
+            logger.info("✏️ Заметка #%s обновлена: '%s' → '%s'", note_id, old_text, text)
+            
+            # Показываем результат с кнопкой возврата
+            result_menu = InlineKeyboardMarkup()
+            result_menu.add(
+                InlineKeyboardButton("📝 Открыть заметку", callback_data=f"note_{note_id}")
+            )
+            
+            await message.reply(
+                f"✅ Заметка обновлена!\n\n"
+                f"<b>Новый текст:</b> {text}\n"
+                f"<b>Категория:</b> {new_category}\n"
+                f"<b>Описание:</b> {new_description}",
+                reply_markup=result_menu
+            )
+            
+            return  # ← ВАЖНО! Выходим, чтобы не создавать новую заметку
                 
         except Exception as e:
-            logger.error(f"❌ Ошибка при редактировании заметки: {e}", exc_info=True)
+            logger.error("❌ Ошибка при редактировании заметки: %s", e, exc_info=True)
             await message.reply("❌ Ошибка при сохранении. Попробуй ещё раз.")
             return
     
     # Проверяем длину заметки (3-60 символов)
-    if len(text) < 3 or len(text) > 60:
+    if not _valid_note(text):
         await message.reply(
             "❌ Заметка должна быть от 3 до 60 символов. Попробуй ещё раз!"
         )
         return
         
     try:
-        LAST_REPLY.pop(message.chat.id, None)
+        await state.pop(f"lr:{message.chat.id}")
 
         if notes_repo and users_repo:
-            # Убеждаемся, что пользователь в БД
-            await users_repo.ensure(message.from_user.id, message.from_user.username)
+            # Пользователь сохраняется в фоне; дождёмся его только перед
+            # созданием заметки (внешний ключ notes.user_id → users.id)
+            ensure_task = _ensure_user(message.from_user)
             
-            # ← НОВОЕ: Показываем статус анализа
-            status_msg = await message.reply("⏳ Анализ...")
+            # ← НОВОЕ: Показываем статус анализа, пока получаем категории
+            status_msg, (user_categories, categories_str) = await asyncio.gather(
+                message.reply("⏳ Анализ..."),
+                _user_categories(message.from_user.id),
+            )
             
-            # ← НОВОЕ: Получаем существующие категории пользователя
-            existing_categories = await notes_repo.get_all_categories(message.from_user.id)
-            user_categories = [cat for cat, _ in existing_categories] if existing_categories else []
-            # ← НОВОЕ: фильтруем None
-            user_categories = [cat for cat in user_categories if cat is not None]
+            if settings.ai_batch_mode:
+                # Быстрая категория по ключевым словам, точный анализ придёт позже
+                category = (await get_suggested_categories(text))[0]
+                await ensure_task
+                note, _ = await asyncio.gather(
+                    notes_repo.create(
+                        user_id=message.from_user.id,
+                        text=text,
+                        category=category
+                    ),
+                    _safe_delete(message.chat.id, status_msg.message_id),
+                )
+                await _forget_categories(message.from_user.id)
+                await analyze_note_deferred(note.id, text, user_categories)
+                
+                logger.info("💾 Заметка #%s создана (анализ отложен): %s → %s", note.id, text, category)
+                
+                await message.reply(
+                    f"✅ Заметка сохранена! 📝\n\n"
+                    f"<b>Текст:</b> {text}\n"
+                    f"<b>Категория:</b> {category}\n\n"
+                    f"Описание пришлю чуть позже."
+                )
+                return
             
             # ← НОВОЕ: Анализируем текст через ИИ
-            ai_result = await analyze_note(text, user_categories)
+            ai_result = await analyze_note(
+                text, user_categories, message.from_user.id, _status_updater(status_msg),
+                categories_str=categories_str
+            )
             category = ai_result.get("category", "🎯 Прочее")
             description = ai_result.get("description", "")
             
-            # Создаём заметку
-            note = await notes_repo.create(
-                user_id=message.from_user.id,
-                text=text,
-                category=category,
-                description=description
+            # Создаём заметку и одновременно удаляем статус-сообщение
+            await ensure_task
+            note, _ = await asyncio.gather(
+                notes_repo.create(
+                    user_id=message.from_user.id,
+                    text=text,
+                    category=category,
+                    description=description
+                ),
+                _safe_delete(message.chat.id, status_msg.message_id),
             )
+            await _forget_categories(message.from_user.id)
             
-            # ← НОВОЕ: Удаляем статус-сообщение
-            with suppress(Exception):
-                await bot.delete_message(message.chat.id, status_msg.message_id)
-            
-            logger.info(f"💾 Заметка #{note.id} создана: {text} → {category}")
+            logger.info("💾 Заметка #%s создана: %s → %s", note.id, text, category)
             
             # ← НОВОЕ: Красивый ответ с информацией от ИИ
             await message.reply(
@@ -632,10 +836,32 @@ async def handle_note(message: types.Message):
             await message.reply("⚠️ Ошибка: БД недоступна")
             
     except Exception as e:
-        logger.error(f"❌ Ошибка при сохранении заметки: {e}", exc_info=True)
+        logger.error("❌ Ошибка при сохранении заметки: %s", e, exc_info=True)
         await message.reply("❌ Ошибка при сохранении заметки. Попробуй ещё раз позже.")
 
 
+# Кнопки меню: нормализованный текст → хендлер. Весь текст проходит через
+# один хендлер и один поиск в словаре вместо фильтра на каждую кнопку;
+# всё, что не кнопка, — это заметка.
+TEXT_HANDLERS = {
+    "❓ помощь": show_help,
+    "помощь": show_help,
+    "🗂️ архив": show_categories,
+    "архив": show_categories,
+}
+
+# Всё, что длиннее самой длинной кнопки, — заметка: такой текст не нормализуем
+TEXT_HANDLERS_MAX_LEN = max(map(len, TEXT_HANDLERS))
+
+@dp.message_handler(content_types=[types.ContentType.TEXT])
+async def route_text(message: types.Message):
+    text = (message.text or "").strip()
+    handler = handle_note
+    if len(text) <= TEXT_HANDLERS_MAX_LEN:
+        handler = TEXT_HANDLERS.get(_norm(text), handle_note)
+    await handler(message)
+
+
 # ===== MAIN =====
 
 if __name__ == "__main__":
@@ -1,15 +1,27 @@
 import os
 from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
 from dotenv import load_dotenv
 
 load_dotenv()
 
-@dataclass
+@dataclass(frozen=True)
 class Settings:
     bot_token: str
     db_url: str
     env: str
     openai_api_key: str
+    semantic_cache_threshold: float = 0.92
+    openai_max_concurrency: int = 8
+    openai_rpm_limit: int = 500
+    ai_batch_mode: bool = False
+    ai_coalesce: bool = False
+    redis_url: Optional[str] = None
+    db_pool_size: int = 20
+    db_max_overflow: int = 40
+    db_pool_timeout: int = 30
+    db_pool_recycle: int = 3600
 
 def _normalize_db_url(url: str) -> str:
     """
@@ -30,9 +42,11 @@ def _normalize_db_url(url: str) -> str:
     
     return url
 
+@lru_cache(maxsize=1)
 def get_settings() -> Settings:
     """
     Загружает настройки из переменных окружения.
+    Читаются один раз — повторные вызовы возвращают тот же объект.
     
     Приоритеты для DB_URL:
     1. DB_URL (если задан)
@@ -49,6 +63,21 @@ def get_settings() -> Settings:
     
     env = os.getenv("ENV", "dev").strip()
     openai_key = os.getenv("OPENAI_API_KEY", "").strip()
+    semantic_threshold = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+    # Ограничения запросов к OpenAI: одновременных и в минуту (0 — без лимита в минуту)
+    openai_max_concurrency = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+    openai_rpm_limit = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+    # AI_BATCH_MODE=1 — анализ через Batch API: дешевле, но описание приходит позже
+    ai_batch_mode = os.getenv("AI_BATCH_MODE", "").strip().lower() in {"1", "true", "yes"}
+    # AI_COALESCE=1 — заметки, пришедшие почти одновременно, анализируются одним запросом
+    ai_coalesce = os.getenv("AI_COALESCE", "").strip().lower() in {"1", "true", "yes"}
+    # REDIS_URL — общее состояние для нескольких процессов бота (иначе — в памяти)
+    redis_url = os.getenv("REDIS_URL", "").strip() or None
+    # Пул соединений БД (для SQLite не используется)
+    db_pool_size = int(os.getenv("DB_POOL_SIZE", "20"))
+    db_max_overflow = int(os.getenv("DB_MAX_OVERFLOW", "40"))
+    db_pool_timeout = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+    db_pool_recycle = int(os.getenv("DB_POOL_RECYCLE", "3600"))
 
     # Валидация обязательных параметров
     if not token:
@@ -61,5 +90,15 @@ def get_settings() -> Settings:
         bot_token=token,
         db_url=db_url,
         env=env,
-        openai_api_key=openai_key
+        openai_api_key=openai_key,
+        semantic_cache_threshold=semantic_threshold,
+        openai_max_concurrency=openai_max_concurrency,
+        openai_rpm_limit=openai_rpm_limit,
+        ai_batch_mode=ai_batch_mode,
+        ai_coalesce=ai_coalesce,
+        redis_url=redis_url,
+        db_pool_size=db_pool_size,
+        db_max_overflow=db_max_overflow,
+        db_pool_timeout=db_pool_timeout,
+        db_pool_recycle=db_pool_recycle
     )
\ No newline at end of file
@@ -1,20 +1,74 @@
+import asyncio
+from contextlib import AsyncExitStack
+
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncEngine
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import NullPool
+
+class Base(DeclarativeBase):
+    pass
 
-Base = declarative_base()
 async_engine: AsyncEngine | None = None 
 async_session: async_sessionmaker[AsyncSession] | None = None
 
-async def init_db(db_url: str) -> async_sessionmaker[AsyncSession]:
+# Параметры пула соединений по умолчанию (для Postgres; переопределяются через Settings)
+POOL_SIZE = 20
+POOL_MAX_OVERFLOW = 40
+POOL_TIMEOUT = 30
+POOL_RECYCLE = 3600
+
+# Параметры соединения asyncpg: JIT Postgres только замедляет короткие запросы бота
+ASYNCPG_CONNECT_ARGS = {
+    "server_settings": {"jit": "off", "application_name": "tg-bot"},
+    "timeout": 10,
+    "command_timeout": 60,
+}
+
+async def init_db(
+    db_url: str,
+    pool_size: int = POOL_SIZE,
+    max_overflow: int = POOL_MAX_OVERFLOW,
+    pool_timeout: int = POOL_TIMEOUT,
+    pool_recycle: int = POOL_RECYCLE,
+) -> async_sessionmaker[AsyncSession]:
     """
     Инициализирует асинхронный engine и sessionmaker.
     Устанавливает глобальные переменные async_engine и async_session.
     """
     global async_engine, async_session
-    async_engine = create_async_engine(db_url, echo=False, future=True)
+    if db_url.startswith("sqlite"):
+        # aiosqlite пул не нужен — соединение с файлом открывается мгновенно
+        engine_kwargs = dict(poolclass=NullPool)
+    else:
+        # LIFO держит "горячими" недавно использованные соединения,
+        # pre_ping отсеивает разорванные сервером после простоя,
+        # recycle не даёт держать соединение дольше часа
+        engine_kwargs = dict(
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=pool_timeout,
+            pool_recycle=pool_recycle,
+            pool_pre_ping=True,
+            pool_use_lifo=True,
+        )
+        if "+asyncpg" in db_url:
+            engine_kwargs["connect_args"] = ASYNCPG_CONNECT_ARGS
+    async_engine = create_async_engine(db_url, echo=False, future=True, **engine_kwargs)
     async_session = async_sessionmaker(async_engine, expire_on_commit=False, class_=AsyncSession)
     return async_session
 
+async def warmup_pool(size: int = POOL_SIZE) -> None:
+    """
+    Заранее открывает size соединений и возвращает их в пул,
+    чтобы первые запросы пользователей не ждали установки соединения.
+    """
+    if async_engine is None or async_engine.dialect.name == "sqlite":
+        return
+    async with AsyncExitStack() as stack:
+        await asyncio.gather(*(
+            stack.enter_async_context(async_engine.connect()) for _ in range(size)
+        ))
+
 def get_async_engine() -> AsyncEngine | None:
     """
     Возвращает глобальный engine (после инициализации).
@@ -26,4 +80,4 @@ def get_async_session() -> async_sessionmaker[AsyncSession] | None:
     """
     Возвращает глобальный sessionmaker.
     """
-    return async_session
\ No newline at end of file
+    return async_session
@@ -1,8 +1,10 @@
 # db/models.py
 
+from datetime import datetime
+from typing import Optional
+
 # --- импорты из SQLAlchemy ---
 from sqlalchemy import (
-    Column,               # базовый класс для столбцов
     Integer,              # тип INTEGER
     BigInteger,           # большой целочисленный тип (для Telegram user_id)
     String,               # строка фикс/переменной длины
@@ -12,7 +14,11 @@ from sqlalchemy import (
     func,                 # SQL-функции (например, NOW())
     Index,                # определение индексов
 )
-from sqlalchemy.orm import relationship  # связь между таблицами (ORM-отношения)
+from sqlalchemy.orm import (
+    Mapped,               # аннотация типа атрибута модели
+    mapped_column,        # столбец в стиле SQLAlchemy 2.0
+    relationship,         # связь между таблицами (ORM-отношения)
+)
 
 # --- наш общий Base из db/base.py ---
 from .base import Base
@@ -25,13 +31,13 @@ class User(Base):
     __tablename__ = "users"                 # имя таблицы в БД
 
     # Telegram user_id. Он уже int и достаточно большой → BigInteger.
-    id = Column(BigInteger, primary_key=True)
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
 
     # username необязателен (может быть None), поэтому nullable=True по умолчанию.
-    username = Column(String(255))
+    username: Mapped[Optional[str]] = mapped_column(String(255))
 
     # когда запись создана. server_default=func.now() — время выставляет сама БД.
-    created_at = Column(DateTime, server_default=func.now())
+    created_at: Mapped[Optional[datetime]] = mapped_column(DateTime, server_default=func.now())
 
 
 # =========================
@@ -40,28 +46,28 @@ class User(Base):
 class Note(Base):
     __tablename__ = "notes"
 
-    id = Column(Integer, primary_key=True)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
 
     # владелец заметки
-    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
 
     # Исходный текст заметки (ровно как ввёл пользователь)
-    text = Column(Text, nullable=False)
+    text: Mapped[str] = mapped_column(Text, nullable=False)
 
     # ← НОВОЕ ПОЛЕ: категория, определённая ИИ (например: "🛒 Покупки")
-    category = Column(String(100), nullable=True, default=None)
+    category: Mapped[Optional[str]] = mapped_column(String(100), nullable=True, default=None)
 
     # Описание от ИИ: контекст, пояснения, дополнения, рекомендации
-    description = Column(Text, nullable=True)
+    description: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
 
     # статус заметки: "active" или "archived"
-    status = Column(String(20), nullable=False, default="active")
+    status: Mapped[str] = mapped_column(String(20), nullable=False, default="active")
 
     # время создания (ставит БД)
-    created_at = Column(DateTime, server_default=func.now())
+    created_at: Mapped[Optional[datetime]] = mapped_column(DateTime, server_default=func.now())
 
     # ORM-связь к User
-    user = relationship("User")
+    user: Mapped["User"] = relationship()
 
 
 # =========================
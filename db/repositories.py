@@ -1,4 +1,9 @@
-from sqlalchemy import select, func
+import time
+from collections import OrderedDict
+
+from sqlalchemy import bindparam, select, func, delete, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from .models import User, Note
 
@@ -12,19 +17,40 @@ class UsersRepo:
     Отвечает за создание пользователя в базе, если его ещё нет.
     """
 
+    # Сколько user_id помнить как "уже есть в БД"
+    SEEN_MAX = 10_000
+
     def __init__(self, sessionmaker):
         # sessionmaker — это фабрика асинхронных сессий (из base.py)
         self.sm = sessionmaker
+        # INSERT ... ON CONFLICT есть у обоих диалектов, но строится разными функциями
+        engine = sessionmaker.kw["bind"]
+        self._insert = sqlite_insert if engine.dialect.name == "sqlite" else pg_insert
+        # LRU уже сохранённых пользователей: для них ensure() не ходит в БД
+        self._seen: OrderedDict[int, None] = OrderedDict()
 
     async def ensure(self, tg_id: int, username: str | None):
         """
-        Проверяет, есть ли пользователь в базе. Если нет — создаёт.
+        Создаёт пользователя, если его ещё нет — одним запросом
+        INSERT ... ON CONFLICT DO NOTHING вместо SELECT + INSERT.
+        Для недавно виденных пользователей запрос не выполняется вовсе.
         """
+        if tg_id in self._seen:
+            self._seen.move_to_end(tg_id)
+            return
+
+        stmt = (
+            self._insert(User)
+            .values(id=tg_id, username=username)
+            .on_conflict_do_nothing(index_elements=["id"])
+        )
         async with self.sm() as s:  # открываем сессию
-            u = await s.get(User, tg_id)  # ищем по id (primary key)
-            if not u:
-                s.add(User(id=tg_id, username=username))
-                await s.commit()
+            await s.execute(stmt)
+            await s.commit()
+
+        self._seen[tg_id] = None
+        if len(self._seen) > self.SEEN_MAX:
+            self._seen.popitem(last=False)
 
 
 # ===============================
@@ -36,8 +62,61 @@ class NotesRepo:
     Отвечает за создание, чтение и выборку заметок.
     """
 
+    # Сколько секунд живёт закэшированный список категорий пользователя.
+    # Кэш локален для процесса: изменения, сделанные другим процессом бота,
+    # он увидит не позже чем через CATEGORIES_TTL.
+    CATEGORIES_TTL = 60.0
+
     def __init__(self, sessionmaker):
         self.sm = sessionmaker
+        # user_id → (время, [(категория, количество), ...]) — как в get_all_categories
+        self._cat_cache: dict[int, tuple[float, list[tuple]]] = {}
+
+    def forget_categories(self, user_id: int) -> None:
+        """Сбрасывает кэш категорий пользователя (после изменения заметок в обход репозитория)."""
+        self._cat_cache.pop(user_id, None)
+
+    def _count_category(self, user_id: int, category: str | None) -> None:
+        # Новая заметка: увеличиваем счётчик в кэше вместо повторного GROUP BY
+        cached = self._cat_cache.get(user_id)
+        if not cached:
+            return
+        rows = [(c, n + 1) if c == category else (c, n) for c, n in cached[1]]
+        if all(c != category for c, _ in cached[1]):
+            rows.append((category, 1))
+        rows.sort(key=lambda row: row[1], reverse=True)
+        self._cat_cache[user_id] = (cached[0], rows)
+
+    # Запросы собираются один раз с bindparam — при каждом вызове меняются
+    # только параметры, и SQLAlchemy берёт скомпилированный SQL из кэша.
+
+    # для списка кнопок нужны только id и текст — description не тянем
+    _Q_BY_CATEGORY = (
+        select(Note.id, Note.text)
+        .where(
+            Note.user_id == bindparam("uid"),
+            Note.category == bindparam("category"),
+            Note.status == "active"
+        )
+        .order_by(Note.created_at.desc())
+        .limit(bindparam("lim"))
+    )
+
+    _Q_LATEST = (
+        select(Note.id, Note.text)
+        .where(Note.user_id == bindparam("uid"), Note.status == "active")
+        .order_by(Note.created_at.desc())
+        .limit(bindparam("lim"))
+    )
+
+    _Q_CATEGORIES = (
+        select(Note.category, func.count(Note.id).label("count"))
+        .where(Note.user_id == bindparam("uid"), Note.status == "active")
+        .group_by(Note.category)
+        .order_by(func.count(Note.id).desc())
+    )
+
+    _Q_OWNED = select(Note).where(Note.id == bindparam("note_id"), Note.user_id == bindparam("uid"))
 
     async def create(self, user_id: int, text: str, category: str | None = None, description: str | None = None):
         """
@@ -60,21 +139,99 @@ class NotesRepo:
             s.add(note)
             await s.commit()
             await s.refresh(note)
-            return note
+        self._count_category(user_id, category)
+        return note
 
-    async def list_latest(self, user_id: int, limit: int = 20):
+    async def get_owned(self, note_id: int, user_id: int) -> Note | None:
         """
-        Возвращает последние N активных заметок пользователя.
+        Возвращает заметку, только если она принадлежит пользователю.
+        Проверка владельца — в WHERE, чужие строки из БД не читаются.
         """
         async with self.sm() as s:
-            query = (
-                select(Note)
-                .where(Note.user_id == user_id, Note.status == "active")
-                .order_by(Note.created_at.desc())
-                .limit(limit)
+            result = await s.execute(self._Q_OWNED, {"note_id": note_id, "uid": user_id})
+            return result.scalar_one_or_none()
+
+    async def delete_returning_category(self, note_id: int, user_id: int):
+        """
+        Удаляет заметку пользователя одним запросом (DELETE ... RETURNING).
+        
+        Returns:
+            строка с полем category удалённой заметки
+            или None, если заметки нет / она чужая
+        """
+        async with self.sm() as s:
+            result = await s.execute(
+                delete(Note)
+                .where(Note.id == note_id, Note.user_id == user_id)
+                .returning(Note.category)
+            )
+            row = result.first()
+            await s.commit()
+        self.forget_categories(user_id)
+        return row
+
+    async def update_note(self, note_id: int, user_id: int, text: str, category: str, description: str) -> bool:
+        """
+        Перезаписывает текст, категорию и описание заметки пользователя одним UPDATE.
+        
+        Returns:
+            True, если заметка нашлась и принадлежит пользователю
+        """
+        async with self.sm() as s:
+            result = await s.execute(
+                update(Note)
+                .where(Note.id == note_id, Note.user_id == user_id)
+                .values(text=text, category=category, description=description)
             )
-            result = await s.execute(query)
-            return result.scalars().all()
+            await s.commit()
+        self.forget_categories(user_id)
+        return result.rowcount > 0
+
+    async def update_analysis(self, note_id: int, category: str, description: str):
+        """
+        Записывает категорию и описание из отложенного ИИ-анализа — только если
+        описания ещё нет. Если пользователь успел отредактировать заметку
+        (правка сразу сохраняет свежий анализ), поздний результат для старого
+        текста отбрасывается.
+        
+        Returns:
+            строка (user_id, text, category, description) или None,
+            если заметки нет или она уже проанализирована
+        """
+        async with self.sm() as s:
+            result = await s.execute(
+                update(Note)
+                .where(Note.id == note_id, Note.description.is_(None))
+                .values(category=category, description=description)
+                .returning(Note.user_id, Note.text, Note.category, Note.description)
+            )
+            row = result.first()
+            await s.commit()
+        if row is not None:
+            self.forget_categories(row.user_id)
+        return row
+
+    async def list_pending_analysis(self):
+        """
+        Возвращает активные заметки, ещё ждущие отложенного ИИ-анализа
+        (описания нет) — строки с id, user_id и text. Нужно, чтобы после
+        перезапуска заново поставить их в очередь Batch API.
+        """
+        async with self.sm() as s:
+            result = await s.execute(
+                select(Note.id, Note.user_id, Note.text)
+                .where(Note.description.is_(None), Note.status == "active")
+                .order_by(Note.id)
+            )
+            return result.all()
+
+    async def list_latest(self, user_id: int, limit: int = 20):
+        """
+        Возвращает последние N активных заметок пользователя (строки с id и text).
+        """
+        async with self.sm() as s:
+            result = await s.execute(self._Q_LATEST, {"uid": user_id, "lim": limit})
+            return result.all()
 
     # ← НОВЫЙ МЕТОД: получить заметки по категории
     async def list_by_category(self, user_id: int, category: str, limit: int = 20):
@@ -85,36 +242,51 @@ class NotesRepo:
             user_id: ID пользователя
             category: название категории (например "🛒 Покупки")
             limit: максимальное количество заметок
+        
+        Returns:
+            строки с полями id и text (для кнопок списка)
         """
         async with self.sm() as s:
-            query = (
-                select(Note)
-                .where(
-                    Note.user_id == user_id,
-                    Note.category == category,
-                    Note.status == "active"
-                )
-                .order_by(Note.created_at.desc())
-                .limit(limit)
+            result = await s.execute(
+                self._Q_BY_CATEGORY, {"uid": user_id, "category": category, "lim": limit}
             )
-            result = await s.execute(query)
-            return result.scalars().all()
+            return result.all()
 
     # ← НОВЫЙ МЕТОД: получить все категории пользователя
-    async def get_all_categories(self, user_id: int):
+    async def get_all_categories(self, user_id: int, fresh: bool = False):
         """
         Возвращает все уникальные категории пользователя с количеством заметок.
+        Запрос в БД — только если кэша нет, он старше CATEGORIES_TTL или fresh=True
+        (нужно, когда результат расходится по другим процессам через Redis).
         
         Returns:
             список кортежей (category, count)
             例: [("🛒 Покупки", 5), ("💡 Идеи", 2)]
         """
+        now = time.monotonic()
+        cached = self._cat_cache.get(user_id)
+        if cached and not fresh and now - cached[0] < self.CATEGORIES_TTL:
+            return cached[1]
+
+        async with self.sm() as s:
+            result = await s.execute(self._Q_CATEGORIES, {"uid": user_id})
+            categories = [tuple(row) for row in result.all()]
+        self._cat_cache[user_id] = (now, categories)
+        return categories
+
+    async def categories_and_notes(self, user_id: int, category: str, limit: int = 20):
+        """
+        Список категорий и заметки одной категории за одну сессию
+        (одно соединение из пула вместо двух).
+        
+        Returns:
+            (категории как в get_all_categories, заметки как в list_by_category)
+        """
         async with self.sm() as s:
-            query = (
-                select(Note.category, func.count(Note.id).label("count"))
-                .where(Note.user_id == user_id, Note.status == "active")
-                .group_by(Note.category)
-                .order_by(func.count(Note.id).desc())
-            )
-            result = await s.execute(query)
-            return result.all()
\ No newline at end of file
+            # AsyncSession не допускает параллельных запросов — выполняем по очереди
+            notes = (await s.execute(
+                self._Q_BY_CATEGORY, {"uid": user_id, "category": category, "lim": limit}
+            )).all()
+            categories = [tuple(row) for row in (await s.execute(self._Q_CATEGORIES, {"uid": user_id})).all()]
+        self._cat_cache[user_id] = (time.monotonic(), categories)
+        return categories, notes
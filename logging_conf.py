@@ -1,11 +1,17 @@
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import queue
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 from pathlib import Path
 
 LOG_DIR = Path("logs")
 LOG_DIR.mkdir(exist_ok=True)
 
+# Фоновый слушатель: реальные хендлеры пишут в поток/файлы вне event loop
+_listener: QueueListener | None = None
+
 def setup_logging(env: str = "dev") -> logging.Logger:
+    global _listener
+
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
 
@@ -24,7 +30,6 @@ def setup_logging(env: str = "dev") -> logging.Logger:
     console = logging.StreamHandler()
     console.setLevel(logging.INFO if env == "dev" else logging.WARNING)
     console.setFormatter(common_fmt)
-    logger.addHandler(console)
 
     file_all = TimedRotatingFileHandler(
         LOG_DIR / "bot.log",
@@ -32,7 +37,6 @@ def setup_logging(env: str = "dev") -> logging.Logger:
     )
     file_all.setLevel(logging.DEBUG)
     file_all.setFormatter(common_fmt)
-    logger.addHandler(file_all)
 
     file_err = TimedRotatingFileHandler(
         LOG_DIR / "errors.log",
@@ -40,10 +44,23 @@ def setup_logging(env: str = "dev") -> logging.Logger:
     )
     file_err.setLevel(logging.ERROR)
     file_err.setFormatter(error_fmt)
-    logger.addHandler(file_err)
+
+    # В корневой логгер кладём только QueueHandler — logger.info() сводится к put()
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+    _listener = QueueListener(log_queue, console, file_all, file_err, respect_handler_level=True)
+    _listener.start()
 
     logging.getLogger("aiogram").setLevel(logging.INFO if env == "dev" else logging.WARNING)
     logging.getLogger("asyncio").setLevel(logging.WARNING)
     logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
 
-    return logger
\ No newline at end of file
+    return logger
+
+
+def stop_logging() -> None:
+    """Дописывает накопленные в очереди записи и останавливает слушатель."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
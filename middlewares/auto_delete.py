@@ -7,11 +7,16 @@ import logging
 logger = logging.getLogger(__name__)
 
 DELETE_COMMANDS = {"/menu", "/start"}
-DELETE_BUTTON_TEXTS = {"📦 архив", "❓ помощь"} 
+DELETE_BUTTON_TEXTS = {"📦 архив", "🗂️ архив", "❓ помощь"}
 
 def norm(s: str) -> str:
     return (s or "").strip().casefold()
 
+# Нормализованные тексты кнопок — считаем один раз, а не на каждое сообщение
+DELETE_BUTTON_NORMALIZED = frozenset(norm(t) for t in DELETE_BUTTON_TEXTS)
+# Текст длиннее любой кнопки кнопкой быть не может — не нормализуем его
+DELETE_BUTTON_MAX_LEN = max(map(len, DELETE_BUTTON_NORMALIZED))
+
 class AutoDeleteCommandsMiddleware(BaseMiddleware):
     async def on_process_message(self, message: types.Message, data: dict):
         txt = (message.text or "").strip()
@@ -21,12 +26,13 @@ class AutoDeleteCommandsMiddleware(BaseMiddleware):
         first = txt.split()[0]  # первое "слово" (для /команд)
         should_delete = (
             first in DELETE_COMMANDS                      # /menu, /start, ...
-            or norm(txt) in {norm(t) for t in DELETE_BUTTON_TEXTS}  # "📦 Архив", "❓ Помощь"
+            or (len(txt) <= DELETE_BUTTON_MAX_LEN
+                and norm(txt) in DELETE_BUTTON_NORMALIZED)  # "🗂️ Архив", "❓ Помощь"
         )
 
         if should_delete:
             try:
                 await message.delete()
-                logger.debug(f"Удалено: {txt!r}")
+                logger.debug("Удалено: %r", txt)
             except Exception as e:
-                logger.warning(f"Не удалось удалить сообщение: {e}")
\ No newline at end of file
+                logger.warning("Не удалось удалить сообщение: %s", e)
\ No newline at end of file
@@ -1,12 +1,14 @@
 import hashlib
+from functools import lru_cache
 from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram import types
 import logging
 
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=100_000)
 def anon_id(user_id: int) -> str:
-    """Анонимизируем user_id: одинаковые пользователи -> одинаковый короткий хэш."""
+    """Анонимизируем user_id: одинаковые пользователи -> одинаковый короткий хэш (кэшируется)."""
     return hashlib.sha1(str(user_id).encode()).hexdigest()[:8]
 
 class TrafficLogMiddleware(BaseMiddleware):
@@ -17,13 +19,13 @@ class TrafficLogMiddleware(BaseMiddleware):
     async def on_process_message(self, message: types.Message, data: dict):
         uid = anon_id(message.from_user.id)
         if self.log_payload:
-            logger.info(f"MSG from {uid}: text={message.text!r}")
+            logger.info("MSG from %s: text=%r", uid, message.text)
         else:
-            logger.info(f"MSG from {uid}: len={len(message.text or '')}")
+            logger.info("MSG from %s: len=%d", uid, len(message.text or ''))
 
     async def on_process_callback_query(self, call: types.CallbackQuery, data: dict):
         uid = anon_id(call.from_user.id)
         if self.log_payload:
-            logger.info(f"CB from {uid}: data={call.data!r}")
+            logger.info("CB from %s: data=%r", uid, call.data)
         else:
-            logger.info(f"CB from {uid}: data_len={len(call.data or '')}")
+            logger.info("CB from %s: data_len=%d", uid, len(call.data or ''))
@@ -0,0 +1,110 @@
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+import orjson
+
+
+# ==============================================
+#   Хранилище состояния между апдейтами
+# ==============================================
+#
+# Ключи вида "lr:<chat_id>" (последний ответ бота) и "es:<user_id>"
+# (редактируемая заметка), значения — целые числа.
+# Ключи "cats:<user_id>" (отрисованный список категорий) хранят JSON —
+# через get_json / set_json.
+# MemoryState живёт в процессе, RedisState позволяет запускать
+# несколько экземпляров бота и переживает перезапуск.
+
+
+class MemoryState:
+    """
+    Состояние в памяти процесса (по умолчанию, без Redis).
+    Просроченные ключи удаляются только при обращении, поэтому размер
+    ограничен: при переполнении вытесняются давно не обновлявшиеся ключи.
+    """
+
+    MAX_KEYS = 50_000
+
+    def __init__(self, max_keys: int = MAX_KEYS) -> None:
+        # ключ → (момент истечения, значение), в порядке последней записи
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._max_keys = max_keys
+
+    async def get(self, key: str) -> Optional[int]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._data[key]
+            return None
+        return entry[1]
+
+    async def set(self, key: str, value: int, ttl: int) -> None:
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        if len(self._data) > self._max_keys:
+            self._data.popitem(last=False)
+
+    async def pop(self, key: str) -> Optional[int]:
+        entry = self._data.pop(key, None)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    async def get_json(self, key: str) -> Any:
+        # В памяти сериализовать незачем — храним объект как есть
+        return await self.get(key)
+
+    async def set_json(self, key: str, value: Any, ttl: int) -> None:
+        await self.set(key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    async def close(self) -> None:
+        self._data.clear()
+
+
+class RedisState:
+    """
+    Состояние в Redis: общее для всех процессов бота, TTL считает сам Redis.
+    """
+
+    def __init__(self, redis) -> None:
+        self.redis = redis
+
+    async def get(self, key: str) -> Optional[int]:
+        value = await self.redis.get(key)
+        return int(value) if value is not None else None
+
+    async def set(self, key: str, value: int, ttl: int) -> None:
+        await self.redis.set(key, value, ex=ttl)
+
+    async def pop(self, key: str) -> Optional[int]:
+        value = await self.redis.getdel(key)
+        return int(value) if value is not None else None
+
+    async def get_json(self, key: str) -> Any:
+        value = await self.redis.get(key)
+        return orjson.loads(value) if value is not None else None
+
+    async def set_json(self, key: str, value: Any, ttl: int) -> None:
+        await self.redis.set(key, orjson.dumps(value), ex=ttl)
+
+    async def delete(self, key: str) -> None:
+        await self.redis.delete(key)
+
+    async def close(self) -> None:
+        await self.redis.aclose()
+
+
+def create_state(redis_url: Optional[str]):
+    """
+    Возвращает RedisState, если задан REDIS_URL, иначе MemoryState.
+    """
+    if not redis_url:
+        return MemoryState()
+
+    from redis import asyncio as aioredis
+    return RedisState(aioredis.from_url(redis_url))